@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+regression check and benchmark of lm.ListMovies.best_match against the
+former implementation (one full SequenceMatcher ratio by title)
+
+titles are guessed from a corpus of real release filenames, and IMDb
+search results are built offline: the right movie among look-alike
+titles, each one with dozens of AKAs (as for foreign releases)
+the chosen match must be the same for every filename
+
+usage: python bench/bench_best_match.py [nb_rounds]
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+from difflib import SequenceMatcher
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), os.pardir) )
+import lm
+import imdb
+
+CORPUS = [
+    ("The.Matrix.1999.1080p.BluRay.x264-HDMaNiAcS.mkv", "The Matrix", 1999),
+    ("Le.Fabuleux.Destin.d.Amelie.Poulain.2001.FRENCH.DVDRip.XviD.avi",
+        "Le fabuleux destin d'Amélie Poulain", 2001),
+    ("Amelie (2001) [1080p].mkv", "Le fabuleux destin d'Amélie Poulain",
+        2001),
+    ("Spirited.Away.2001.JAPANESE.1080p.BluRay.H264.AAC-VXT.mp4",
+        "Sen to Chihiro no kamikakushi", 2001),
+    ("Das.Boot.1981.Directors.Cut.GERMAN.720p.BluRay.x264.mkv",
+        "Das Boot", 1981),
+    ("la.haine.1995.720p.FRENCH.BRRip.avi", "La haine", 1995),
+    ("Crouching Tiger Hidden Dragon 2000 CD1.avi",
+        "Wo hu cang long", 2000),
+    ("Crouching Tiger Hidden Dragon 2000 CD2.avi",
+        "Wo hu cang long", 2000),
+    ("Pans.Labyrinth.2006.SPANISH.720p.BluRay.x264.mkv",
+        "El laberinto del fauno", 2006),
+    ("The Good, the Bad and the Ugly (1966) [BDRip].mkv",
+        "Il buono, il brutto, il cattivo", 1966),
+    ("City.of.God.2002.PORTUGUESE.1080p.WEBRip.mkv", "Cidade de Deus", 2002),
+    ("Oldboy.2003.KOREAN.720p.BluRay.x264-WiKi.mkv", "Oldeuboi", 2003),
+    ("Seven.Samurai.1954.Criterion.1080p.mkv", "Shichinin no samurai", 1954),
+    ("Alien.1979.Directors.Cut.720p.mkv", "Alien", 1979),
+    ("Aliens 1986 Special Edition.avi", "Aliens", 1986),
+    ("the.lives.of.others.2006.720p.mkv", "Das Leben der Anderen", 2006),
+    ("Intouchables.2011.FRENCH.DVDRiP.XViD.avi", "Intouchables", 2011),
+    ("The.Intouchables.2011.720p.BluRay.mkv", "Intouchables", 2011),
+    ("Cinema.Paradiso.1988.ITALIAN.DVDRip.avi",
+        "Nuovo Cinema Paradiso", 1988),
+    ("Blade Runner 1982 Final Cut 1080p.mkv", "Blade Runner", 1982),
+    ("Run.Lola.Run.1998.GERMAN.avi", "Lola rennt", 1998),
+    ("Jules.et.Jim.1962.avi", "Jules et Jim", 1962),
+    ("Star.Wars.1977.Despecialized.mkv", "Star Wars", 1977),
+    ("Wings.of.Desire.1987.Criterion.mkv", "Der Himmel über Berlin", 1987),
+    ("The.Hunt.2012.DANISH.720p.mkv", "Jagten", 2012),
+    ("Let.the.Right.One.In.2008.SWEDISH.mkv", "Låt den rätte komma in",
+        2008),
+    ("Downfall.2004.GERMAN.DVDRip.avi", "Der Untergang", 2004),
+    ("leon.the.professional.1994.extended.mkv", u"Léon", 1994),
+    ("Persona (1966).mkv", "Persona", 1966),
+    ("Rashomon.1950.mkv", "Rashômon", 1950),
+    ("untitled_home_video_2010.avi", None, None),
+    ("Movie.Without.Year.DVDRip.avi", "Movie", None),
+]
+
+LANGUAGES = ['(France)', '(Germany)', '(Italy)', '(Spain)', '(Japan)',
+        '(Brazil)', '(Russia)', '(Poland)', '(Sweden)', '(Korea)',
+        '(USA)', '(UK)', '(Argentina)', '(Finland)', '(Greece)']
+
+WORDS = ("the of and la le der die das el il lo de du des night day dream "
+        "man woman house city war love death life red blue black white "
+        "story return king queen road river sea sky fire ice time dark "
+        "light game").split()
+
+def legacy_best_match(guess_title, guess_year, results):
+# best_match as of lm v0.4 (without IMDb search), kept as reference
+    _guessed_title = lm.alphanum( guess_title ).lower()
+    _guessed_year  = guess_year
+
+    _results = [ r for r in results if isinstance(r,imdb.Movie.Movie) ]
+    if _guessed_year:
+        _results = [ r for r in _results if r.has_key('year') \
+                                    and r['year'] == _guessed_year ]
+
+    _best_ratio  = 0
+    _best_result = None
+
+    for r in _results:
+
+        _list_titles  = [ lm.alphanum(title.split('::')[0]).lower() \
+                                for title in (r.get('akas') or [])]
+        _list_titles += [ lm.alphanum(r.get('title')).lower() ]
+
+        for other_title in _list_titles:
+            cur_ratio = SequenceMatcher(None,
+                        other_title,_guessed_title).ratio()
+
+            if cur_ratio > _best_ratio:
+                _best_ratio, _best_result = cur_ratio, r
+
+    unsure = _best_ratio < 0.7
+
+    if _best_ratio < 0.7 and _guessed_year:
+        _best_result, unsure = legacy_best_match(guess_title,None,results)
+
+    return _best_result, unsure
+
+def variant(rnd, title):
+# a look-alike title: some words changed, added or removed
+    words = lm.alphanum(title).split() or ['movie']
+    for k in range( rnd.randint(1, 3) ):
+        op = rnd.randint(0, 2)
+        i = rnd.randint(0, len(words)-1)
+        if op == 0:
+            words[i] = rnd.choice(WORDS)
+        elif op == 1:
+            words.insert(i, rnd.choice(WORDS))
+        elif len(words) > 1:
+            del words[i]
+    return ' '.join(words).title()
+
+def search_results(rnd, guess, title, year, nb_results=20, nb_akas=30):
+# offline search results: look-alike movies, and the right one somewhere
+    results = []
+    base = title or guess['g_title'] or 'movie'
+    for k in range(nb_results):
+        name = variant(rnd, base)
+        data = {'title':name, 'year':(year or 2000) + rnd.randint(-3,3),
+                'akas':[ "%s::%s" % (variant(rnd, name), rnd.choice(LANGUAGES))
+                    for a in range(rnd.randint(0, nb_akas)) ]}
+        results.append( imdb.Movie.Movie(movieID="%07d" % k, data=data) )
+    if title:
+        akas = [ "%s::%s" % (guess['g_title'].title(), rnd.choice(LANGUAGES)) ]
+        akas += [ "%s::%s" % (variant(rnd, title), rnd.choice(LANGUAGES))
+                for a in range(nb_akas) ]
+        rnd.shuffle(akas)
+        right = imdb.Movie.Movie(movieID="9999999", data={'title':title,
+            'year':year, 'akas':akas})
+        results.insert( rnd.randint(0, len(results)), right )
+    return results
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    logging.getLogger("LM").setLevel(logging.CRITICAL)
+    sys.argv = sys.argv[:1]
+    options, args = lm.parse_arguments()
+
+    home = os.environ.get('HOME')
+    import tempfile, shutil
+    os.environ['HOME'] = tempfile.mkdtemp(prefix="lm_bench_")
+    try:
+        LM = lm.ListMovies( options )
+    finally:
+        shutil.rmtree( os.environ['HOME'] )
+        os.environ['HOME'] = home
+
+    rnd = random.Random(0)
+    cases = []
+    for r in range(rounds):
+        for filename, title, year in CORPUS:
+            guess = LM.guessed_title_year( filename )
+            cases.append( (guess, search_results(rnd, guess, title, year)) )
+
+    def run(best_match):
+        start = time.time()
+        found = [ best_match(g['g_title'], g['g_year'], results)
+                for g, results in cases ]
+        return time.time()-start, found
+
+    legacy_time, legacy = run( legacy_best_match )
+    new_time, new = run( LM.best_match )
+
+    diff = [ (cases[k][0], a, b) for k, (a, b) in enumerate(zip(legacy,new))
+            if a[1] != b[1] or (a[0] and a[0].movieID) != \
+                    (b[0] and b[0].movieID) ]
+    for guess, a, b in diff[:10]:
+        print( "!!! %s: %s / %s" % (guess, a, b) )
+
+    print( "%d searches, %d different matches" % (len(cases), len(diff)) )
+    print( "legacy best_match: %.2fs (%.1f ms/search)" % \
+            (legacy_time, 1000*legacy_time/len(cases)) )
+    print( "best_match       : %.2fs (%.1f ms/search)" % \
+            (new_time, 1000*new_time/len(cases)) )
+    sys.exit( 1 if diff else 0 )
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark of lm.guess_title_year and lm.guess_titles_years (batch
+filename parsing, each basename parsed once) against the former
+ListMovies.guessed_title_year, on a corpus of real-world release
+names with their expected title and year, tagged by round to keep
+basenames mostly distinct: parsing speed and accuracy are reported
+together, with the names both implementations parse differently
+
+usage: python bench/bench_guess.py [nb_rounds] [-v]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), os.pardir) )
+import lm
+
+# release name, expected title, expected year
+CORPUS = [
+    ("The.Matrix.1999.1080p.BluRay.x264-HDMaNiAcS.mkv", "the matrix", 1999),
+    ("Inception.2010.720p.BrRip.x264.YIFY.mp4", "inception", 2010),
+    ("The.Dark.Knight.2008.1080p.BluRay.x264.DTS-FGT.mkv",
+        "the dark knight", 2008),
+    ("Pulp Fiction (1994) [1080p].mkv", "pulp fiction", 1994),
+    ("Fight Club 1999 DVDRip XviD.avi", "fight club", 1999),
+    ("fight.club.1999.dvdrip.xvid-ftw.avi", "fight club", 1999),
+    ("Le.Fabuleux.Destin.d.Amelie.Poulain.2001.FRENCH.DVDRip.XviD.avi",
+        "le fabuleux destin d amelie poulain", 2001),
+    ("Amelie (2001) [1080p].mkv", "amelie", 2001),
+    ("Spirited.Away.2001.JAPANESE.1080p.BluRay.H264.AAC-VXT.mp4",
+        "spirited away", 2001),
+    ("Das.Boot.1981.Directors.Cut.GERMAN.720p.BluRay.x264.mkv",
+        "das boot", 1981),
+    ("la.haine.1995.720p.FRENCH.BRRip.avi", "la haine", 1995),
+    ("Crouching Tiger Hidden Dragon 2000 CD1.avi",
+        "crouching tiger hidden dragon", 2000),
+    ("Crouching Tiger Hidden Dragon 2000 CD2.avi",
+        "crouching tiger hidden dragon", 2000),
+    ("Pans.Labyrinth.2006.SPANISH.720p.BluRay.x264.mkv",
+        "pans labyrinth", 2006),
+    ("The Good, the Bad and the Ugly (1966) [BDRip].mkv",
+        "the good the bad and the ugly", 1966),
+    ("City.of.God.2002.PORTUGUESE.1080p.WEBRip.mkv", "city of god", 2002),
+    ("Oldboy.2003.KOREAN.720p.BluRay.x264-WiKi.mkv", "oldboy", 2003),
+    ("Seven.Samurai.1954.Criterion.1080p.mkv", "seven samurai", 1954),
+    ("Alien.1979.Directors.Cut.720p.mkv", "alien", 1979),
+    ("Aliens 1986 Special Edition.avi", "aliens", 1986),
+    ("the.lives.of.others.2006.720p.mkv", "the lives of others", 2006),
+    ("Intouchables.2011.FRENCH.DVDRiP.XViD.avi", "intouchables", 2011),
+    ("Cinema.Paradiso.1988.ITALIAN.DVDRip.avi", "cinema paradiso", 1988),
+    ("Blade Runner 1982 Final Cut 1080p.mkv", "blade runner", 1982),
+    ("Run.Lola.Run.1998.GERMAN.avi", "run lola run", 1998),
+    ("Jules.et.Jim.1962.avi", "jules et jim", 1962),
+    ("Wings.of.Desire.1987.Criterion.mkv", "wings of desire", 1987),
+    ("Let.the.Right.One.In.2008.SWEDISH.mkv", "let the right one in", 2008),
+    ("Downfall.2004.GERMAN.DVDRip.avi", "downfall", 2004),
+    ("leon.the.professional.1994.extended.mkv", "leon the professional",
+        1994),
+    ("Persona (1966).mkv", "persona", 1966),
+    ("Rashomon.1950.mkv", "rashomon", 1950),
+    ("2001.A.Space.Odyssey.1968.1080p.mkv", "2001 a space odyssey", 1968),
+    ("1917.2019.1080p.WEBRip.x264.mkv", "1917", 2019),
+    ("Blade.Runner.2049.2017.2160p.UHD.mkv", "blade runner 2049", 2017),
+    ("Apocalypse Now Redux.avi", "apocalypse now redux", None),
+    ("apocalypse now dvdrip divx.avi", "apocalypse now", None),
+    ("The Shining TS.avi", "the shining", None),
+    ("Avatar.2009.CAM.XViD-IMAGiNE.avi", "avatar", 2009),
+    ("Avatar 2009 DVDSCR XviD AAC.avi", "avatar", 2009),
+    ("Zodiac.2007.R5.LiNE.XviD-ViSiON.avi", "zodiac", 2007),
+    ("Heat.1995.Remastered.BDRip.mkv", "heat", 1995),
+    ("Once Upon a Time in the West (1968).mkv",
+        "once upon a time in the west", 1968),
+    ("Stalker [1979] Tarkovsky.mkv", "stalker", 1979),
+    ("Breathless - A bout de souffle (1960).avi",
+        "breathless a bout de souffle", 1960),
+    ("M (1931).mkv", "m", 1931),
+    ("Up.2009.720p.mkv", "up", 2009),
+    ("Her.2013.mkv", "her", 2013),
+    ("Whiplash 2014 MULTi 1080p.mkv", "whiplash", 2014),
+    ("amores perros 2000 SPANiSH dvdrip.avi", "amores perros", 2000),
+    ("Les.Quatre.Cents.Coups.1959.FRENCH.avi", "les quatre cents coups",
+        1959),
+    ("Tokyo.Story.1953.JAPANESE.mkv", "tokyo story", 1953),
+    ("The.Seventh.Seal.1957.SWEDISH.mkv", "the seventh seal", 1957),
+    ("Metropolis.1927.Restored.mkv", "metropolis", 1927),
+    ("Nosferatu.1922.avi", "nosferatu", 1922),
+    ("movie.cd1.avi", "movie cd1", None),
+    ("Vertigo.1958.mkv", "vertigo", 1958),
+    ("The.Thing.1982.mkv", "the thing", 1982),
+    ("Mad.Max.Fury.Road.2015.mkv", "mad max fury road", 2015),
+    ("Jaws (1975) CD1.avi", "jaws", 1975),
+]
+
+def legacy_guessed_title_year( files ):
+# ListMovies.guessed_title_year as of lm v0.4, kept as reference
+    forbidden_words = ['divx','dvdrip','xvid','ts','dvdscr',
+                     'cam','dvdscr','xvid','aac','r5']
+
+    title_reg = re.compile('^[^[(]+')
+    before_year_reg = re.compile(r'(.*)[12][1089][0-9]{2}.*')
+    upper_reg = re.compile(r'(^.+?)[A-Z]{2}.*')
+
+    init_title = os.path.splitext(os.path.basename(files))[0]
+
+    tmp_title = lm.alphanum(
+            (re.findall(title_reg,init_title) or [init_title])[0] )
+    tmp_title = re.sub(before_year_reg, r'\1', tmp_title) or tmp_title
+    title     = re.sub(upper_reg,r'\1', tmp_title) or tmp_title
+
+    if len(title) < 3:
+        title = tmp_title
+
+    title = title.strip().lower()
+
+    title_words = title.split(' ')
+    for forbidden in forbidden_words:
+            if forbidden in title_words:
+                title_words.remove(forbidden)
+    title = ' '.join(title_words)
+    guessed_year = re.findall('([12][1089][0-9]{2})', init_title) or None
+    guessed_year = int(guessed_year[0]) if guessed_year else None
+    if guessed_year < 1800 or 2100 < guessed_year:
+        guessed_year = None
+
+    return {'g_title':title.strip(), 'g_year':guessed_year}
+
+def accuracy( guesses ):
+# (right titles, right years) against CORPUS expected values
+    titles = sum( 1 for g, c in zip(guesses, CORPUS) if g['g_title']==c[1] )
+    years  = sum( 1 for g, c in zip(guesses, CORPUS) if g['g_year']==c[2] )
+    return titles, years
+
+if __name__ == "__main__":
+    args = [ a for a in sys.argv[1:] if a != '-v' ]
+    verbose = '-v' in sys.argv
+    rounds = int(args[0]) if args else 200
+
+    # distinct paths with mostly distinct basenames, as in a real library:
+    # CORPUS names first (checked for accuracy), then tagged by round
+    names = [ c[0] for c in CORPUS ]
+    paths = [ os.path.join( "/movies/0", n ) for n in names ]
+    for r in range(1, rounds):
+        paths.extend( os.path.join( "/movies/%d" % r,
+            "%s-r%d%s" % (os.path.splitext(n)[0], r, os.path.splitext(n)[1]) )
+            for n in names )
+
+    start = time.time()
+    legacy = [ legacy_guessed_title_year(p) for p in paths ]
+    legacy_time = time.time() - start
+
+    start = time.time()
+    single = [ lm.guess_title_year(p) for p in paths ]
+    single_time = time.time() - start
+
+    start = time.time()
+    new = lm.guess_titles_years( paths )
+    new_time = time.time() - start
+
+    legacy, new = legacy[:len(CORPUS)], new[:len(CORPUS)]
+    single = single[:len(CORPUS)]
+    for n, (a, b) in enumerate( zip(legacy, new) ):
+        if a != b or b != single[n]:
+            print( "!!! %s: %s -> %s" % (CORPUS[n][0], a, b) )
+    if verbose:
+        for g, c in zip(new, CORPUS):
+            if (g['g_title'], g['g_year']) != c[1:]:
+                print( "%s: %s, expected %s" % (c[0], g, c[1:]) )
+
+    distinct = len( set( os.path.basename(p) for p in paths ) )
+    print( "%d names (%d distinct basenames, %.1f%% duplicates)" % (
+        len(paths), distinct, 100.*(len(paths)-distinct)/len(paths)) )
+    for label, guesses, elapsed in [("legacy", legacy, legacy_time),
+            ("single", single, single_time), ("batch", new, new_time)]:
+        titles, years = accuracy( guesses )
+        print( "%-7s: %7.0f names/s, titles %d/%d, years %d/%d" % (label,
+            len(paths)/elapsed, titles, len(CORPUS), years, len(CORPUS)) )
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+micro-benchmark of lm.hashFile against the former 8 bytes per read
+implementation, on a corpus of sparse files (random data at head and tail)
+
+usage: python bench/bench_hash.py [nb_files]
+"""
+
+import os
+import sys
+import time
+import shutil
+import struct
+import tempfile
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), os.pardir) )
+import lm
+
+# hashFile as of lm v0.4, kept as reference
+def legacy_hashFile(name):
+    try:
+
+        longlongformat = 'q'  # long long
+        bytesize = struct.calcsize(longlongformat)
+
+        f = open(name, "rb")
+
+        filesize = os.path.getsize(name)
+        hash = filesize
+
+        if filesize < 65536 * 2:
+                return "SizeError"
+
+        for x in range(65536/bytesize):
+                buffer = f.read(bytesize)
+                (l_value,)= struct.unpack(longlongformat, buffer)
+                hash += l_value
+                hash = hash & 0xFFFFFFFFFFFFFFFF #to remain as 64bit number
+
+        f.seek(max(0,filesize-65536),0)
+        for x in range(65536/bytesize):
+                buffer = f.read(bytesize)
+                (l_value,)= struct.unpack(longlongformat, buffer)
+                hash += l_value
+                hash = hash & 0xFFFFFFFFFFFFFFFF
+
+        f.close()
+        returnedhash =  "%016x" % hash
+        return returnedhash
+
+    except(IOError):
+            return "IOError"
+
+def build_corpus( directory, nb_files ):
+    files = []
+    for i in range(nb_files):
+        fn = os.path.join( directory, "movie_%04d.avi" % i )
+        size = (700 + i) * 1024 * 1024
+        with open(fn, 'wb') as f:
+            f.write( os.urandom(65536) )
+            f.seek( size - 65536 )
+            f.write( os.urandom(65536) )
+        files.append(fn)
+    return files
+
+def bench( func, files, repeat=3 ):
+    best = None
+    for r in range(repeat):
+        start = time.time()
+        for fn in files:
+            func(fn)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(files) / best
+
+if __name__ == "__main__":
+
+    nb_files = int(sys.argv[1]) if len(sys.argv)>1 else 200
+    directory = tempfile.mkdtemp( prefix='lm_bench_hash_' )
+    try:
+        files = build_corpus( directory, nb_files )
+
+        for fn in files:
+            assert lm.hashFile(fn) == legacy_hashFile(fn), fn
+
+        before = bench( legacy_hashFile, files )
+        after  = bench( lm.hashFile, files )
+
+        print( "%d sparse files, numpy: %s" % (nb_files, bool(lm.numpy)) )
+        print( "before: %10.1f hashes/s" % before )
+        print( "after : %10.1f hashes/s" % after )
+        print( "speedup: x%.1f" % (after / before) )
+    finally:
+        shutil.rmtree( directory )
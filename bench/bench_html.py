@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark of the HTML sumup (ListMovies.html_build) on a synthetic cache
+of N movies (see bench_listing.py): first build, build again without
+change, and after a change of one movie, against the former single
+table page
+
+usage: python bench/bench_html.py [nb_movies]
+"""
+
+import os
+import sys
+import time
+import codecs
+import shutil
+import logging
+import tempfile
+
+sys.path.insert( 0, os.path.dirname(__file__) )
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), os.pardir) )
+import lm
+from bench_listing import fill_cache
+
+def legacy_html_build( LM, files ):
+# html_build as of lm v0.4, kept as reference
+    cell = u"<td width=200 height=250><a href=\"%(imdb)s\">\
+       %(title)s</a><br> \
+       <font color=%(color)s>%(genre)s<br>\
+       note: %(rating)s, votes: %(votes)s<br>\
+       size: %(size)iMo</font><br>\
+       <a href='%(trailer)s'><img src='%(cover)s' height=150></a><br>\
+       <small>%(file)s</small></td>\n"
+
+    with codecs.open(LM.html_fn + '.legacy','w','utf-8') as out_file:
+        out_file.write("<table>\n")
+        count = 0
+        for f in files:
+            if count % 5 == 0:
+                if count > 0: out_file.write("</tr>")
+                out_file.write("<tr height=200>")
+
+            h = LM.hash_from_path(f)
+            if h['m_id']:
+                values_dict = {
+                    'imdb' :'http://www.imdb.com/title/tt'+h['m_id'],
+                    'file' : os.path.basename(f)[0:20],
+                    'size' : round(h['bytesize']/(1024*1024),1)\
+                    if os.path.exists(f) else 0,
+                    'title': h['m_title'],
+                    'color': '#FF3333' if h['g_unsure'] else '#808080',
+                    'rating' : str(h['m_rating']) or 'None',
+                    'votes': str(round(h['m_votes']/1000,1))+'K' if \
+                            h['m_votes'] else 'None',
+                    'cover': h['m_cover'],
+                    'genre': ', '.join(h['m_genre'][0:2]),
+                 'trailer':'http://www.youtube.com/results?search_query='+
+                            lm.alphanum( h['m_title'],'+')+'+trailer'
+                            }
+                out_file.write( cell % values_dict )
+            count += 1
+        out_file.write("</tr></table>")
+
+def timed( options, files, build, change=None ):
+# runs build(LM, files) on a new ListMovies -> (seconds, files written)
+    LM = lm.ListMovies( options )
+    if change:
+        change( LM )
+        LM.save_cache()
+    before = dict( (f, os.path.getmtime(os.path.join(LM.html_dir, f)))
+            for f in os.listdir(LM.html_dir) ) \
+                    if os.path.exists(LM.html_dir) else {}
+    start = time.time()
+    build( LM, files )
+    elapsed = time.time() - start
+    written = [ f for f in os.listdir(LM.html_dir) if f.startswith('page_')
+            and before.get(f) != os.path.getmtime(os.path.join(LM.html_dir,
+                f)) ] if os.path.exists(LM.html_dir) else []
+    LM.close_cache()
+    return elapsed, len(written)
+
+if __name__ == "__main__":
+    nb_movies = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    logging.getLogger("LM").setLevel(logging.CRITICAL)
+    sys.argv = sys.argv[:1]
+    options, args = lm.parse_arguments()
+
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = tempfile.mkdtemp(prefix="lm_bench_")
+    try:
+        LM = lm.ListMovies( options )
+        files = fill_cache( LM, nb_movies )
+        LM.close_cache()
+
+        def change( LM ):
+            h = LM.cache_path[ files[nb_movies//2] ]['hash']
+            LM.cache_hash[h]['m_rating'] = 9.9
+
+        build = lm.ListMovies.html_build
+        results = [ ("legacy",) + timed( options, files, legacy_html_build ),
+            ("first build",) + timed( options, files, build ),
+            ("no change",) + timed( options, files, build ),
+            ("one change",) + timed( options, files, build, change ) ]
+        size = os.path.getsize( LM.html_fn + '.legacy' )
+        data_size = sum( os.path.getsize(os.path.join(LM.html_dir, f))
+                for f in os.listdir(LM.html_dir) )
+        page_size = os.path.getsize( LM.html_fn )
+    finally:
+        shutil.rmtree( os.environ['HOME'] )
+        os.environ['HOME'] = home
+
+    print( "%d movies" % nb_movies )
+    for label, elapsed, written in results:
+        print( "%-12s %6.2fs, %d data files written" % (label, elapsed,
+            written) )
+    print( "legacy page: %.1f MB, page: %.1f kB + data: %.1f MB" % (
+        size/1e6, page_size/1e3, data_size/1e6) )
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark of movie listings (ListMovies.show_list) on a synthetic cache
+of N movies: text lines (short, -l, -L) and --format jsonl/csv/tsv,
+against the former listing (one stdout write by movie, every line
+rendered), and again once lines are kept in cache
+
+output goes to /dev/null, files are not accessed
+
+usage: python bench/bench_listing.py [nb_movies]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import tempfile
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), os.pardir) )
+import lm
+
+GENRES = ['Action', 'Drama', 'Comedy', 'Thriller', 'Crime', 'Sci-Fi',
+        'Romance', 'Horror', 'War', 'Western']
+
+def fill_cache( LM, nb_movies ):
+# synthetic movies, one file each -> list of paths
+    rnd = random.Random(0)
+    paths = []
+    for i in range(nb_movies):
+        h = "%016x" % rnd.getrandbits(64)
+        path = u"/movies/%03d/Movie.%05d.2001.720p.mkv" % (i % 500, i)
+        LM.cache_path[path] = lm.store( {'hash':h, 'last_update':time.time()} )
+        LM.cache_hash[h] = lm.movie_record( {'bytesize':rnd.randint(7e8,4e9),
+            'm_id':"%07d" % i, 'm_title':u"Le Fabuleux Destin n°%d" % i,
+            'm_year':rnd.randint(1930, 2020),
+            'm_rating':rnd.randint(10,90)/10.,
+            'm_votes':rnd.randint(10, 10**6), 'm_genre':rnd.sample(GENRES, 3),
+            'm_director':[u"Jean-Pierre Jeunet"], 'm_countries':[u"France"],
+            'm_cast':[ u"Actor %d" % k for k in range(15) ],
+            'm_short_summary':u"A short summary.",
+            'm_summary':u"A much longer summary. " * 10,
+            'm_last_update':time.time(), 'o_imdb_id':"%07d" % i} )
+        paths.append( path )
+    LM.save_cache()
+    return paths
+
+def legacy_show_list( LM, files ):
+# show_list as of lm v0.4: one (or two) stdout writes by movie
+    for f in files:
+        h = LM.hash_from_path(f)
+        if h['m_id']:
+            sys.stdout.write( LM.render_line(h, LM.display_mode()).replace(
+                lm.FILENAME_MARK, os.path.basename(f).encode('utf-8') ) )
+
+def timed( options, files, show, **attrs ):
+# runs show(LM, files) with LM attributes set, caches being read from
+# disk as in a new lm call
+    LM = lm.ListMovies( options )
+    for k, v in attrs.items():
+        setattr( LM, k, v )
+    start = time.time()
+    show( LM, files )
+    sys.stdout.flush()
+    elapsed = time.time() - start
+    LM.close_cache()
+    return elapsed
+
+if __name__ == "__main__":
+    nb_movies = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    logging.getLogger("LM").setLevel(logging.CRITICAL)
+    sys.argv = sys.argv[:1]
+    options, args = lm.parse_arguments()
+
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = tempfile.mkdtemp(prefix="lm_bench_")
+    stdout = sys.stdout
+    try:
+        LM = lm.ListMovies( options )
+        files = fill_cache( LM, nb_movies )
+        LM.close_cache()
+
+        results = []
+        sys.stdout = open( os.devnull, 'w' )
+        for label, attrs in [ ("short", {}), ("-l", {'disp_long':True}),
+                ("-L", {'disp_very_long':True}) ]:
+            legacy = timed( options, files, legacy_show_list, **attrs )
+            new = timed( options, files, lm.ListMovies.show_list, **attrs )
+            again = timed( options, files, lm.ListMovies.show_list, **attrs )
+            results.append( (label, legacy, new, again) )
+        for fmt in lm.OUTPUT_FORMATS:
+            new = timed( options, files, lm.ListMovies.show_list,
+                    out_format=fmt )
+            results.append( ("--format " + fmt, None, new, None) )
+        sys.stdout.close()
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree( os.environ['HOME'] )
+        os.environ['HOME'] = home
+
+    print( "%d movies, movies/s:" % nb_movies )
+    print( "%-15s %10s %10s %10s" % ('', 'legacy', 'listing', 'again') )
+    rate = lambda t: "%10.0f" % (nb_movies/t) if t else "%10s" % '-'
+    for label, legacy, new, again in results:
+        print( "%-15s %s %s %s" % (label, rate(legacy), rate(new),
+            rate(again)) )
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+end-to-end benchmark of lm OpenSubtitles calls against the local fake
+server (bench/fake_opensubtitles.py): update_cache_hash_opensubtitles
+and download_subtitle, for libraries of 100, 1k and 10k files
+
+each library is a temporary directory of sparse movie files (one per
+directory, as subtitles are written next to movies), with its own ~/.lm
+
+usage: python bench/bench_opensubtitles.py [--sizes 100,1000,10000]
+        [--latency 0.05] [--error-rate 0.] [--rate N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert( 0, os.path.dirname(__file__) )
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), os.pardir) )
+import lm
+from fake_opensubtitles import fake_opensubtitles, serve
+
+SIZE = 256 * 1024
+
+def make_library( root, nb_files ):
+# sparse files, with a distinct head and tail -> list of paths
+    paths = []
+    for i in range(nb_files):
+        d = os.path.join( root, "movies", "movie %05d" % i )
+        os.makedirs(d)
+        path = os.path.join( d, u"Movie.%05d.2001.720p.mkv" % i )
+        with open(path, 'wb') as f:
+            f.write( os.urandom(64) )
+            f.seek( SIZE-64 )
+            f.write( os.urandom(64) )
+        paths.append(path)
+    return paths
+
+def run( nb_files, url, jobs ):
+    root = tempfile.mkdtemp(prefix="lm_bench_")
+    home = os.environ.get('HOME')
+    os.environ['HOME'] = root
+    try:
+        paths = make_library( root, nb_files )
+        sys.argv = ['lm.py', '--opensubtitles-url', url,
+                '--opensubtitles-jobs', str(jobs)]
+        options, args = lm.parse_arguments()
+        LM = lm.ListMovies( options )
+        LM.update_caches_with_paths( paths )
+
+        start = time.time()
+        LM.update_cache_hash_opensubtitles( paths )
+        check = time.time() - start
+
+        # movies found by hash get their imdb id, as after IMDb lookup
+        for h in LM.hashs_from_paths( paths ):
+            LM.cache_hash[h]['m_id'] = LM.cache_hash[h]['o_imdb_id']
+        LM.save_cache()
+        found = [ p for p in paths if
+                LM.cache_hash[ LM.cache_path[p]['hash'] ]['m_id'] ]
+
+        start = time.time()
+        LM.download_subtitle( paths, 'eng' )
+        download = time.time() - start
+        subs = sum( 1 for p in found if os.path.exists(
+            os.path.splitext(p)[0] + "_ENG_LM1.srt") )
+
+        LM.close_cache()
+        return check, len(found), download, subs
+    finally:
+        if home is not None:
+            os.environ['HOME'] = home
+        shutil.rmtree( root )
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default="100,1000,10000")
+    parser.add_argument('--latency', type=float, default=.05)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--rate', type=int, default=None)
+    parser.add_argument('--jobs', type=int,
+            default=lm.ListMovies.opensubtitles_jobs)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = parse_arguments()
+    logging.getLogger("LM").setLevel(logging.CRITICAL)
+
+    fake = fake_opensubtitles( latency=options.latency,
+            error_rate=options.error_rate, rate=options.rate, seed=0 )
+    server, url = serve( fake )
+    print( "fake server %s: latency %.3fs, error rate %.2f, rate %s" % \
+            (url, options.latency, options.error_rate, options.rate) )
+    print( "%8s %12s %12s %12s %12s" % ('files', 'check (s)', 'hashs/s',
+        'download (s)', 'subs/s') )
+
+    for n in [ int(n) for n in options.sizes.split(',') ]:
+        check, found, download, subs = run( n, url, options.jobs )
+        print( "%8d %12.2f %12.0f %12.2f %12.0f" % ( n, check, n/check,
+            download, subs/max(download, 1e-6) ) )
+        if subs < found:
+            print( "!!! %d subtitles written for %d movies" % (subs, found) )
+
+    server.shutdown()
+    print( "calls: %s" % str(fake.calls) )
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+benchmark of cache_hash entries: former store (dict subclass) against
+lm.movie_record (slots), for memory, pickled size, load time (unpickling
+of cache rows) and item access
+
+usage: python bench/bench_record.py [nb_entries]
+"""
+
+import os
+import sys
+import time
+import cPickle
+
+sys.path.insert( 0, os.path.join(os.path.dirname(__file__), os.pardir) )
+import lm
+
+def sample( i ):
+    data = dict( lm.MOVIE_FIELDS )
+    data.update( {'bytesize':700*1024*1024+i, 'm_id':'%07d' % i,
+        'm_title':u'Movie %d' % i, 'm_canonical_title':u'Movie %d' % i,
+        'm_rating':5+i%50/10., 'm_year':1950+i%70, 'm_genre':[u'Drama'],
+        'm_countries':[u'France'], 'm_director':[u'Some One'],
+        'm_cast':[u'Actor %d' % k for k in range(10)],
+        'm_last_update':time.time(), 'g_title':u'movie %d' % i } )
+    return data
+
+def deep_size( obj ):
+    # memory of a cache entry: container + keys slots, values are shared
+    return sys.getsizeof(obj) + ( sys.getsizeof(obj.__dict__) \
+            if hasattr(obj, '__dict__') else 0 )
+
+def timed( func, *args ):
+    start = time.time()
+    result = func( *args )
+    return time.time() - start, result
+
+def load_stores( blobs ):
+    result = []
+    for b in blobs:
+        v = lm.store( cPickle.loads(b) )
+        result.append( v )
+    return result
+
+def load_records( blobs ):
+    return [ lm.movie_record.from_values( cPickle.loads(b) ) for b in blobs ]
+
+def access( entries ):
+    total = 0
+    for e in entries:
+        if e['m_id'] and e['m_rating'] > 6 and not e['g_unsure']:
+            total += e['bytesize']
+        e['unknown_key']
+    return total
+
+if __name__ == "__main__":
+
+    nb = int(sys.argv[1]) if len(sys.argv)>1 else 100000
+    data = [ sample(i) for i in range(nb) ]
+
+    store_blobs  = [ cPickle.dumps( d, 2 ) for d in data ]
+    record_blobs = [ cPickle.dumps( lm.movie_record(d).values(), 2 ) \
+            for d in data ]
+
+    t_store, stores   = timed( load_stores, store_blobs )
+    t_record, records = timed( load_records, record_blobs )
+
+    a_store, r1  = timed( access, stores )
+    a_record, r2 = timed( access, records )
+    assert r1 == r2
+
+    print( "%d entries                 store     movie_record" % nb )
+    print( "memory / entry (bytes) %9d %12d" % ( deep_size(stores[0]),
+            deep_size(records[0]) ) )
+    print( "pickled size (MB)      %9.1f %12.1f" % (
+            sum(map(len,store_blobs))/1e6, sum(map(len,record_blobs))/1e6 ))
+    print( "load time (s)          %9.3f %12.3f" % (t_store, t_record) )
+    print( "access time (s)        %9.3f %12.3f" % (a_store, a_record) )
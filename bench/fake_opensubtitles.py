@@ -0,0 +1,219 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+local stand-in for the OpenSubtitles XMLRPC server, serving canned data
+(LogIn, LogOut, NoOperation, CheckMovieHash, SearchSubtitles,
+DownloadSubtitles, InsertMovieHash) with configurable latency, error rate
+and rate limit, to test and benchmark lm offline
+
+answers only depend on the requested hashs / imdb ids: a hash is known
+with probability --known, its imdb id is derived from the hash, and each
+imdb id has 3 subtitles per language
+
+usage: python bench/fake_opensubtitles.py [--port 8069] [--latency 0.1]
+then:  lm.py --opensubtitles-url http://localhost:8069 ...
+or:    LM_OPENSUBTITLES_URL=http://localhost:8069 lm.py ...
+"""
+
+import sys
+import time
+import zlib
+import base64
+import random
+import argparse
+import threading
+import SocketServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+OK          = "200 OK"
+UNAUTHORIZED= "401 Unauthorized"
+TOO_MANY    = "429 Too many requests"
+UNAVAILABLE = "503 Service Unavailable"
+
+SUBTITLE    = u"1\n00:00:01,000 --> 00:00:04,000\nsubtitle %s\n"
+
+class handler(SimpleXMLRPCRequestHandler):
+    # keep-alive connections, as api.opensubtitles.org
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+class threaded_server(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+class fake_opensubtitles(object):
+    # XMLRPC methods of the fake server
+    # @param latency: seconds added to each call (+/- jitter)
+    # @param error_rate: probability of a '503' answer
+    # @param rate: max calls per second, others get a '429' answer
+    # @param known: probability of a hash to be known
+    # @param token_ttl: seconds before a token expires ('401' answer)
+
+    def __init__(self, latency=0., jitter=0., error_rate=0., rate=None,
+            known=.8, token_ttl=900, seed=None):
+        self.latency    = latency
+        self.jitter     = jitter
+        self.error_rate = error_rate
+        self.rate       = rate
+        self.known      = known
+        self.token_ttl  = token_ttl
+        self.random     = random.Random(seed)
+        self.lock       = threading.Lock()
+        self.tokens     = {}
+        self.calls      = {}
+        self.window     = []
+        self.inserted   = []
+
+    def _call(self, method, token=None):
+    # common part of every call: latency, stats, rate limit, errors
+    # and token check, returns an error status or None
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            now = time.time()
+            self.window = [ t for t in self.window if t > now-1 ]
+            limited = self.rate and len(self.window) >= self.rate
+            self.window.append( now )
+            failed = self.random.random() < self.error_rate
+            delay = max( 0., self.latency + \
+                    self.random.uniform(-self.jitter, self.jitter) )
+        time.sleep( delay )
+
+        if limited:
+            return TOO_MANY
+        if failed:
+            return UNAVAILABLE
+        if token is not None:
+            with self.lock:
+                last = self.tokens.get(token)
+                if last is None or last < time.time()-self.token_ttl:
+                    return UNAUTHORIZED
+                self.tokens[token] = time.time()
+        return None
+
+    def _imdb_id(self, h):
+    # imdb id of a known hash, None for unknown ones
+        n = int(h, 16) if h else 0
+        if (n % 1000) < self.known * 1000:
+            return "%07d" % (n % 9999991 + 1)
+        return None
+
+    def LogIn(self, user, password, language, useragent):
+        status = self._call('LogIn')
+        if status:
+            return {'status':status}
+        with self.lock:
+            token = "%032x" % self.random.getrandbits(128)
+            self.tokens[token] = time.time()
+        return {'status':OK, 'token':token, 'seconds':0.01}
+
+    def LogOut(self, token):
+        status = self._call('LogOut')
+        with self.lock:
+            self.tokens.pop(token, None)
+        return {'status':status or OK}
+
+    def NoOperation(self, token):
+        return {'status':self._call('NoOperation', token) or OK}
+
+    def CheckMovieHash(self, token, hashs):
+        status = self._call('CheckMovieHash', token)
+        if status:
+            return {'status':status}
+        data = {}
+        for h in hashs[:200]:
+            imdb_id = self._imdb_id(h)
+            if imdb_id:
+                data[h] = {'MovieHash':h, 'MovieImdbID':imdb_id,
+                        'MovieName':'Movie %s' % imdb_id,
+                        'MovieYear':str(1950 + int(imdb_id) % 70)}
+            else:
+                data[h] = []
+        return {'status':OK, 'data':data, 'seconds':0.01}
+
+    def SearchSubtitles(self, token, queries):
+        status = self._call('SearchSubtitles', token)
+        if status:
+            return {'status':status}
+        data = []
+        for q in queries[:500]:
+            lang = q.get('sublanguageid', 'eng')
+            if q.get('moviehash'):
+                imdb_id = self._imdb_id(q['moviehash'])
+                if imdb_id:
+                    data.append( self._sub(imdb_id, lang, 0,
+                        q['moviehash']) )
+            elif q.get('imdbid'):
+                imdb_id = "%07d" % int(q['imdbid'])
+                data.extend( self._sub(imdb_id, lang, k) for k in range(3) )
+        return {'status':OK, 'data':data or False, 'seconds':0.01}
+
+    def _sub(self, imdb_id, lang, k, h="0"):
+        return {'IDSubtitleFile':"%s%d" % (imdb_id, k),
+                'IDMovieImdb':str(int(imdb_id)), 'MovieHash':h,
+                'SubLanguageID':lang, 'SubDownloadsCnt':str(1000-k),
+                'SubFileName':'Movie %s.srt' % imdb_id}
+
+    def DownloadSubtitles(self, token, sub_ids):
+        status = self._call('DownloadSubtitles', token)
+        if status:
+            return {'status':status}
+        data = [ {'idsubtitlefile':i, 'data':base64.standard_b64encode(
+            zlib.compress( (SUBTITLE % i).encode('utf-8') ))}
+            for i in sub_ids[:20] ]
+        return {'status':OK, 'data':data or 'False', 'seconds':0.01}
+
+    def InsertMovieHash(self, token, movies):
+        status = self._call('InsertMovieHash', token)
+        if status:
+            return {'status':status}
+        with self.lock:
+            self.inserted.extend( movies )
+        return {'status':OK, 'data':{'accepted_moviehashes':
+            [ m['moviehash'] for m in movies ], 'new_imdbs':[]}}
+
+def serve(fake, host="localhost", port=0):
+# starts the fake server in a daemon thread -> (server, url)
+# port 0 picks a free port
+    server = threaded_server( (host, port), requestHandler=handler,
+            logRequests=False, allow_none=True )
+    server.register_instance( fake )
+    thread = threading.Thread( target=server.serve_forever )
+    thread.daemon = True
+    thread.start()
+    return server, "http://%s:%d" % server.server_address
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--port', type=int, default=8069)
+    parser.add_argument('--latency', type=float, default=0.,
+            help="seconds added to each call")
+    parser.add_argument('--jitter', type=float, default=0.,
+            help="random +/- seconds added to latency")
+    parser.add_argument('--error-rate', type=float, default=0.,
+            help="probability of a '503' answer")
+    parser.add_argument('--rate', type=int, default=None,
+            help="max calls per second, others get a '429' answer")
+    parser.add_argument('--known', type=float, default=.8,
+            help="probability of a hash to be known")
+    parser.add_argument('--token-ttl', type=int, default=900,
+            help="seconds before an unused token expires")
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = parse_arguments()
+    fake = fake_opensubtitles( options.latency, options.jitter,
+            options.error_rate, options.rate, options.known,
+            options.token_ttl, options.seed )
+    server, url = serve( fake, options.host, options.port )
+    print( "fake OpenSubtitles server on %s" % url )
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print( "calls: %s" % str(fake.calls) )
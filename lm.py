@@ -26,6 +26,8 @@ import re
 import sys
 import time
 import imdb
+import gzip
+import heapq
 import zlib
 import struct
 import base64
@@ -33,11 +35,37 @@ import codecs
 import locale
 import logging
 import cPickle
+import csv
+import json
+import shutil
+import Queue
+import hashlib
+import sqlite3
 import argparse
 import xmlrpclib
+import threading
+from stat import S_ISDIR
+from itertools import izip, izip_longest
+from multiprocessing.pool import ThreadPool
+from collections import namedtuple, OrderedDict
 from difflib import SequenceMatcher
 from unicodedata import normalize
 
+# faster file hashing, if available
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# faster directory listing (python >= 3.5, or scandir package)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 # windows terminal coloration
 from platform import system
 if system().lower()=="windows":
@@ -68,6 +96,31 @@ This software is a command line tool for listing movies using IMDb metadata
 OPENSUBTITLE_USER_AGENT = "lm v2.0"
 OPENSUBTITLE_DOMAIN     = "http://api.opensubtitles.org/xml-rpc"
 
+# CheckMovieHash requests: hashs per request (150 at most), retries
+# on error, and first retry delay in seconds (doubled at each retry)
+OPENSUBTITLE_BATCH      = 150
+OPENSUBTITLE_RETRIES    = 3
+OPENSUBTITLE_BACKOFF    = 2
+# in --stream mode, seconds a partial batch waits for more hashs
+OPENSUBTITLE_STREAM_WAIT= 1.
+# queries per SearchSubtitles request, subtitles per DownloadSubtitles one
+OPENSUBTITLE_SEARCHES   = 100
+OPENSUBTITLE_DOWNLOADS  = 20
+
+# IMDb requests: max requests per second (all threads), retries
+# on error, and first retry delay in seconds (doubled at each retry)
+IMDB_RATE       = 5
+IMDB_RETRIES    = 3
+IMDB_BACKOFF    = 2
+
+# listings: machine readable formats (--format) and their fields, and
+# size in bytes of the chunks written to stdout
+OUTPUT_FORMATS  = ('jsonl', 'csv', 'tsv')
+OUTPUT_FIELDS   = ('path', 'm_id', 'm_title', 'm_year', 'm_rating',
+        'm_votes', 'm_genre', 'm_director', 'm_countries', 'm_cast',
+        'bytesize', 'o_imdb_id', 'g_unsure')
+OUTPUT_CHUNK    = 64 * 1024
+
 # ********** LOGGiING ********************************************************
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -88,71 +141,256 @@ def fileLogging( format, level, filename):
     logger.addHandler(fileLogger)
 
 # ********** UTILITY FUNCTIONS ***********************************************
-# returns all files in dir (and subdir if recurs==True) filter
-# by specified extensions
+# one stat per file: a file found by filelist() is described by a FileEntry,
+# carried along to get_files() and the cache updaters
+FileEntry = namedtuple('FileEntry', ['path','size','mtime','inode','device'])
+
+# values of a directory in the directory manifest (~/.lm/cache_dirs)
+CACHE_DIRS_LAYOUT = ('mtime', 'paths', 'subdirs')
+
+def file_entry( path, st=None ):
+    """ FileEntry of a path, None if it can't be stat'ed """
+    try:
+        st = st or os.stat(path)
+    except OSError:
+        return None
+    return FileEntry( path, st.st_size, st.st_mtime, st.st_ino, st.st_dev )
+
+def _list_dir( dir ):
+    # returns (name, path, is_dir, stat_function) for entries of dir
+    # with scandir, d_type tells files from dirs without any stat,
+    # and DirEntry.stat() is cached
+    if scandir:
+        for e in scandir(dir):
+            try:
+                is_dir = e.is_dir()
+            except OSError:
+                continue
+            yield e.name, e.path, is_dir, e.stat
+    else:
+        for f in os.listdir(dir):
+            path = os.path.join(dir,f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield f, path, S_ISDIR(st.st_mode), (lambda st=st: st)
+
+# returns (files, subdirs, number of entries) of a single directory,
+# files being FileEntry records filtered by specified extensions
+def dir_content( dir, *ext ):
+    files, subdirs = [], []
+
+    for name, path, is_dir, stat in _list_dir( dir ):
+        if not isinstance(name,unicode):
+            logger.warning("%s filename not properly encoded" % name)
+        elif is_dir:
+            subdirs.append(path)
+        elif not ext or (os.path.splitext(name)[1].lower() in ext):
+            try:
+                entry = file_entry( path, stat() )
+            except OSError:
+                entry = None
+            if entry:
+                files.append(entry)
+
+    return files, subdirs
+
+# yields all files in dir (and subdir if recurs==True) filter
+# by specified extensions, as FileEntry records
 def filelist( dir, recurs=True, *ext):
     """ recursive listing of files in a directory matching extension """
-    result, alist = [], []
+    files, subdirs = dir_content( os.path.abspath(dir), *ext )
 
-    for f in os.listdir(dir):
-        if not isinstance(f,unicode):
-            logger.warning("%s filename not properly encoded" % f)
-        else:
-            alist.append( os.path.abspath(os.path.join(dir,f)) )
+    for entry in files:
+        yield entry
 
-    result.extend( [ f for f in filter( os.path.isfile, alist ) \
-        if (not ext or (os.path.splitext(f)[1].lower() in ext)) ] )
     if recurs:
-        for f in [ d for d in alist if not os.path.isfile(d)]:
-            if os.path.exists(f):
-                result.extend( filelist( f, True, *ext) )
-    return result
-
-# opensubtitle hash function
-def hashFile(name):
+        for d in subdirs:
+            for entry in filelist( d, True, *ext):
+                yield entry
+
+# opensubtitle hash function: file size + sum of the 64bit little endian
+# words of the first and last 64KiB, modulo 2**64
+# (see http://trac.opensubtitles.org/projects/opensubtitles/wiki/
+# HashSourceCodes)
+# filesize can be given when already known, to save a stat call
+HASH_CHUNK  = 65536
+# chunks are read as 32bit words, much cheaper to sum than 64bit ones:
+# each 64bit word is (low + high << 32)
+HASH_STRUCT = struct.Struct( '<%dI' % (HASH_CHUNK/4) )
+
+def _chunk_sum( chunk ):
+    if numpy:
+        return int( numpy.frombuffer(chunk, '<u8').sum(dtype=numpy.uint64) )
+    words = HASH_STRUCT.unpack(chunk)
+    return sum(words[::2]) + (sum(words[1::2]) << 32)
+
+def hashFile(name, filesize=None):
     try:
 
-        longlongformat = 'q'  # long long
-        bytesize = struct.calcsize(longlongformat)
+        if filesize is None:
+            filesize = os.path.getsize(name)
 
-        f = open(name, "rb")
+        if filesize < HASH_CHUNK * 2:
+                return "SizeError"
 
-        filesize = os.path.getsize(name)
-        hash = filesize
+        with open(name, "rb") as f:
+            head = f.read(HASH_CHUNK)
+            f.seek(filesize-HASH_CHUNK,0)
+            tail = f.read(HASH_CHUNK)
 
-        if filesize < 65536 * 2:
-                return "SizeError"
+        if len(head) != HASH_CHUNK or len(tail) != HASH_CHUNK:
+            return "IOError"
 
-        for x in range(65536/bytesize):
-                buffer = f.read(bytesize)
-                (l_value,)= struct.unpack(longlongformat, buffer)
-                hash += l_value
-                hash = hash & 0xFFFFFFFFFFFFFFFF #to remain as 64bit number
-
-        f.seek(max(0,filesize-65536),0)
-        for x in range(65536/bytesize):
-                buffer = f.read(bytesize)
-                (l_value,)= struct.unpack(longlongformat, buffer)
-                hash += l_value
-                hash = hash & 0xFFFFFFFFFFFFFFFF
-
-        f.close()
-        returnedhash =  "%016x" % hash
+        hash = filesize + _chunk_sum(head) + _chunk_sum(tail)
+        returnedhash =  "%016x" % (hash & 0xFFFFFFFFFFFFFFFF)
         return returnedhash
 
-    except(IOError):
+    except(IOError, OSError):
             return "IOError"
 
 # keeps only ascii alpha numeric character
+ALPHANUM_REG = re.compile( '[^a-zA-Z0-9]{1,}' )
+
 def alphanum( string, fill=' ' ):
     string = to_ascii( string )
-    return re.sub( '[^a-zA-Z0-9]{1,}', fill, string ).strip()
+    return ALPHANUM_REG.sub( fill, string ).strip()
 
 def to_ascii( string ):
     if not isinstance( string, unicode ):
         string = unicode(string,'cp850')
     return normalize( 'NFKD', string ).encode('ascii', 'ignore')
 
+# ********** FILENAME PARSING ************************************************
+# words of release names which are not part of titles
+FORBIDDEN_WORDS = frozenset( ['divx','dvdrip','xvid','ts','dvdscr',
+                     'cam','aac','r5'] )
+
+# we take everything before information in bracket
+# or square bracket, as these info are usually not part of the title
+TITLE_REG       = re.compile( '^[^[(]+' )
+# the year is most of time placed between
+# the title and other information, we are intersted by what is before
+BEFORE_YEAR_REG = re.compile( r'(.*)[12][1089][0-9]{2}.*' )
+# in some case, we have the title with lowercases,
+# and other info (e.g. language) fully uppercase, this regex test this
+UPPER_REG       = re.compile( r'(^.+?)[A-Z]{2}.*' )
+YEAR_REG        = re.compile( '([12][1089][0-9]{2})' )
+
+def guess_title_year( filename, forbidden=FORBIDDEN_WORDS ):
+# Try to guess title and year from a movie filename
+# -> {'g_title':, 'g_year':}
+    init_title = os.path.splitext(os.path.basename(filename))[0]
+
+    tmp_title = alphanum( (TITLE_REG.findall(init_title) or [init_title])[0] )
+    # 2nd regex
+    tmp_title = BEFORE_YEAR_REG.sub( r'\1', tmp_title ) or tmp_title
+    # 3rd regex
+    title     = UPPER_REG.sub( r'\1', tmp_title ) or tmp_title
+
+    # In some cases, the previous regex give a wrong title,
+    # we try to detect this by cancelling too short title
+    if len(title) < 3:
+        title = tmp_title
+
+    #we now remove forbidden words
+    title = ' '.join( w for w in title.strip().lower().split(' ')
+            if not w in forbidden )
+
+    guessed_year = YEAR_REG.search( init_title )
+    guessed_year = int(guessed_year.group(1)) if guessed_year else None
+    if guessed_year < 1800 or 2100 < guessed_year:
+        guessed_year = None
+
+    return {'g_title':title.strip(), 'g_year':guessed_year}
+
+# the same patterns, applied to a whole batch of names at once: names are
+# joined by newlines, and each pattern matches every line of the batch
+BATCH_TITLE_REG       = re.compile( r'^([^[(\n]*).*$', re.M )
+BATCH_YEAR_REG        = re.compile( r'^(?:.*?([12][1089][0-9]{2}))?.*$', re.M )
+BATCH_ALPHANUM_REG    = re.compile( '[^a-zA-Z0-9\n]+' )
+BATCH_SPACES_REG      = re.compile( ' *\n *' )
+BATCH_BEFORE_YEAR_REG = re.compile( r'^(.+)[12][1089][0-9]{2}.*$', re.M )
+BATCH_UPPER_REG       = re.compile( r'^(.+?)[A-Z]{2}.*$', re.M )
+
+def guess_titles_years( filenames, forbidden=FORBIDDEN_WORDS ):
+# guess_title_year of a list of filenames, each basename parsed once
+# each step of guess_title_year is done by one pass on the batch
+# -> list of {'g_title':, 'g_year':}, in filenames order
+    names = {}
+    for filename in filenames:
+        name = os.path.basename( filename )
+        if not name in names:
+            names[name] = len(names)
+    if not names:
+        return []
+    inits = [None] * len(names)
+    for name, n in names.iteritems():
+        inits[n] = os.path.splitext(name)[0].replace('\n', ' ')
+    batch = '\n'.join( inits )
+
+    years = BATCH_YEAR_REG.findall( batch )
+    titles = BATCH_TITLE_REG.findall( batch )
+    tmp_titles = '\n'.join( t or i for t, i in izip(titles, inits) )
+    tmp_titles = BATCH_ALPHANUM_REG.sub( ' ', to_ascii( tmp_titles ) )
+    tmp_titles = BATCH_SPACES_REG.sub( '\n', tmp_titles ).strip(' ')
+    tmp_titles = BATCH_BEFORE_YEAR_REG.sub( r'\1', tmp_titles )
+    titles = BATCH_UPPER_REG.sub( r'\1', tmp_titles ).lower().split('\n')
+    tmp_titles = tmp_titles.lower().split('\n')
+
+    parsed = []
+    for title, tmp_title, year in izip( titles, tmp_titles, years ):
+        if len(title) < 3:
+            title = tmp_title
+        title = ' '.join( w for w in title.strip().split(' ')
+                if not w in forbidden )
+        year = int(year) if year else None
+        if year < 1800 or 2100 < year:
+            year = None
+        parsed.append( (title.strip(), year) )
+
+    return [ dict( zip( ('g_title', 'g_year'),
+        parsed[ names[os.path.basename(f)] ] ) ) for f in filenames ]
+
+# limits calls of wait() to 'rate' per second, over all threads
+class rate_limiter(object):
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0
+        self.lock     = threading.Lock()
+        self.next     = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep( delay )
+
+# write() calls are gathered, and written to stream by chunks of
+# about 'size' bytes
+class output_buffer(object):
+
+    def __init__(self, stream, size=OUTPUT_CHUNK):
+        self.stream = stream
+        self.size   = size
+        self.parts  = []
+        self.length = 0
+
+    def write(self, data):
+        self.parts.append( data )
+        self.length += len(data)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.stream.write( ''.join(self.parts) )
+            self.parts, self.length = [], 0
+        self.stream.flush()
+
 # boolean yes / no raw_input
 def boolean_input(msg):
     res = None
@@ -171,6 +409,13 @@ def parse_arguments():
     parser.add_argument('-r','--reverse',
             action="store_true", default=False,
             help="show media in reverse order")
+    parser.add_argument('-n','--limit', type=int, default=None,
+            help="show only the N first media of the sorted list,\
+                    e.g. -r -n 20 for the 20 best rated")
+    parser.add_argument('--stream', action="store_true",
+            help="show each movie as soon as it is known: cached movies\
+                    first, then new ones while they are hashed and looked\
+                    up, in no particular order")
     parser.add_argument('-d','--delete_cache',
             action="store_true", default=False,
             help="delete targeted files in cache. A confirmation is \
@@ -188,6 +433,9 @@ def parse_arguments():
             help="Show full information on movie")
     parser.add_argument('-o','--outline', action="store_true",
             help="Show plot outline")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS,
+            help="list movies as JSON lines, CSV or TSV (with a header),\
+                    with raw cache fields: %s" % ', '.join(OUTPUT_FIELDS))
     parser.add_argument('--confirm', default=False,
             action="store_true",
             help="Manually confirm/search selected movies. May be usefull\
@@ -212,6 +460,48 @@ def parse_arguments():
             help="media files to check, by default looks at current dir")
     parser.add_argument('--reset', action="store_true",
             help="Delete all cache files (use it when corrupted")
+    parser.add_argument('-j','--jobs', type=int, default=ListMovies.jobs,
+            help="Number of files hashed at the same time (default: %d)" \
+                    % ListMovies.jobs)
+    parser.add_argument('--device-jobs', type=int,
+            default=ListMovies.device_jobs,
+            help="Number of files hashed at the same time on one device\
+                    (default: %d), use 1 for a spinning disk" % \
+                    ListMovies.device_jobs)
+    parser.add_argument('--imdb-jobs', type=int,
+            default=ListMovies.imdb_jobs,
+            help="Number of IMDb requests at the same time (default: %d)"\
+                    % ListMovies.imdb_jobs)
+    parser.add_argument('--opensubtitles-url',
+            default=os.environ.get('LM_OPENSUBTITLES_URL',
+                OPENSUBTITLE_DOMAIN),
+            help="OpenSubtitles XMLRPC server (default: LM_OPENSUBTITLES_URL\
+                    environment variable, or %s)" % OPENSUBTITLE_DOMAIN)
+    parser.add_argument('--opensubtitles-jobs', type=int,
+            default=ListMovies.opensubtitles_jobs,
+            help="Number of OpenSubtitles requests at the same time\
+                    (default: %d)" % ListMovies.opensubtitles_jobs)
+    parser.add_argument('--opensubtitles-batch', type=int,
+            default=OPENSUBTITLE_BATCH,
+            help="Number of hashs per OpenSubtitles request\
+                    (default and max: %d)" % OPENSUBTITLE_BATCH)
+    parser.add_argument('--build-title-index', nargs=2,
+            metavar=('BASICS', 'AKAS'),
+            help="Build the offline title index from IMDb datasets files\
+                    title.basics.tsv.gz and title.akas.tsv.gz (see\
+                    https://datasets.imdbws.com/), to find movies without\
+                    IMDb searches")
+    parser.add_argument('--refresh-ratings', metavar='RATINGS',
+            help="Update ratings and votes of all cached movies from IMDb\
+                    datasets file title.ratings.tsv.gz (see\
+                    https://datasets.imdbws.com/)")
+    parser.add_argument('--size-range', metavar='MIN:MAX',
+            help="List cached movies between MIN and MAX Mb (one of them\
+                    can be omitted, e.g. 700: or :1400), from cache only,\
+                    without accessing files")
+    parser.add_argument('--rescan', action="store_true",
+            help="List again every directory, even if unchanged since\
+                    last call")
     parser.add_argument('--debug', action="store_true",
             help="Display debug logging info, and write log message in\
                      ~/.lm/lm_log.txt")
@@ -231,8 +521,28 @@ def parse_arguments():
     if options.confirm or options.upload:
         options.long = True
 
+    if options.stream and ( options.alphabetical or options.reverse or \
+            options.delete_cache or options.confirm or options.upload or \
+            options.download or options.show_imdb or options.show or \
+            options.html_build or options.size_range ):
+        logger.error("--stream only lists movies, unsorted")
+        exit(2)
+
+    if options.size_range:
+        try:
+            low, high = options.size_range.split(':')
+            options.size_range = ( float(low) if low else None,
+                                   float(high) if high else None )
+        except ValueError:
+            logger.error("Wrong syntax for size range, use MIN:MAX (Mb)")
+            exit(2)
+
     # take care of the 'unsure' filter
+    # keys are looked up in the (unicode) terms index: the phrase is decoded
+    # as file arguments are, then lowercased by decode_filter_phrase
     if options.filter:
+        encoding = locale.getdefaultlocale()[1]
+        if encoding: options.filter = options.filter.decode( encoding )
         try:
             options.filter_dict = decode_filter_phrase( options.filter )
 
@@ -291,12 +601,40 @@ def decode_filter_phrase( filter_phrase ):
             except:
                 raise FilterParsingError("Wrong syntax for size filtering")
 
+        # one list of keys by clause: movies have to match one key of
+        # each clause
         if not result.has_key(ftype): result[ftype] = []
 
-        result[ftype].extend( fkeys )
+        result[ftype].append( fkeys )
 
     return result
 
+# filter types searched in the terms index, and their cache_hash field
+FILTER_FIELDS = { 'genre':'m_genre', 'cast':'m_cast',
+        'director':'m_director', 'countries':'m_countries' }
+
+def compile_filter( filter_dict ):
+# compiles the output of decode_filter_phrase to a list of clauses:
+# ('size', [(sign, Mb)]) for size filters (sign 1: bigger than, -1:
+# smaller), ('unsure',), and (type, set of lowercase keys) for others,
+# starting by the most selective ones. As for other types, movies have to
+# match one size key of a clause: @size:-100,+2000 keeps movies smaller
+# than 100Mb or bigger than 2000Mb
+    clauses = []
+    for ftype, fkeys in (filter_dict or {}).iteritems():
+        for keys in fkeys:
+            if ftype == 'size':
+                clauses.append( ('size', [ (-1 if k < 0 else 1, abs(k))
+                    for k in keys ]) )
+            elif ftype == 'unsure':
+                clauses.append( ('unsure',) )
+            else:
+                clauses.append( (ftype, set( k.strip() for k in keys )) )
+    order = dict( (t, n) for n, t in enumerate(['director', 'cast',
+        'countries', 'genre', 'unsure', 'size']) )
+    clauses.sort( key=lambda c: order[c[0]] )
+    return clauses
+
 
 
 # ********** Exceptions ******************************************************
@@ -350,27 +688,1220 @@ class store(dict):
             self[k] = v
 
 
+# fields of a cache_hash entry, with default values
+# new fields must be appended: records are stored as tuples of values
+MOVIE_FIELDS = (
+    ('bytesize'            , None),
+    ('imdb_check'          , 0),
+    ('m_id'                , None),
+    ('m_title'             , None),
+    ('m_canonical_title'   , None),
+    ('m_rating'            , None),
+    ('m_year'              , None),
+    ('m_genre'             , None),
+    ('m_countries'         , None),
+    ('m_director'          , None),
+    ('m_short_summary'     , None),
+    ('m_summary'           , None),
+    ('m_cast'              , None),
+    ('m_votes'             , None),
+    ('m_cover'             , None),
+    ('m_last_update'       , None),
+    ('o_imdb_id'           , None),
+    ('o_year'              , None),
+    ('o_check'             , 0),
+    ('o_title'             , None),
+    ('g_title'             , None),
+    ('g_year'              , None),
+    ('g_unsure'            , False),
+    ('m_error'             , None),
+    )
+MOVIE_KEYS     = tuple( k for k, v in MOVIE_FIELDS )
+MOVIE_DEFAULTS = tuple( v for k, v in MOVIE_FIELDS )
+
+# fixed keys record of a movie, same semantics as store (unknown key
+# returns None, only known keys can be set), with much cheaper access
+# and memory use than a dict: values are held in slots.
+# When attached to a table (see sqlite_hashs), changes are reported
+# to the table 'changes' set.
+class movie_record(object):
+
+    __slots__ = MOVIE_KEYS + ('_key', '_changes')
+
+    _fields = frozenset(MOVIE_KEYS)
+
+    def __init__(self, data=None, key=None, changes=None):
+        for k, v in MOVIE_FIELDS:
+            object.__setattr__(self, k, v)
+        self._key, self._changes = key, None
+        if data:
+            self.update(data)
+        self._changes = changes
+
+    @classmethod
+    def from_values(cls, values, key=None, changes=None):
+    # record from a tuple of values (see values()), shorter tuples
+    # from older versions get default values for missing fields
+        self = cls.__new__(cls)
+        setattr_ = object.__setattr__
+        for k, v in zip( MOVIE_KEYS, values ):
+            setattr_(self, k, v)
+        for k, v in MOVIE_FIELDS[len(values):]:
+            setattr_(self, k, v)
+        self._key, self._changes = key, changes
+        return self
+
+    def values(self):
+        return tuple( getattr(self, k) for k in MOVIE_KEYS )
+
+    def keys(self):
+        return list( MOVIE_KEYS )
+
+    def iteritems(self):
+        for k in MOVIE_KEYS:
+            yield k, getattr(self, k)
+
+    def items(self):
+        return list( self.iteritems() )
+
+    def __iter__(self):
+        return iter(MOVIE_KEYS)
+
+    def __len__(self):
+        return len(MOVIE_KEYS)
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return getattr(self, key)
+        return None
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fields else default
+
+    def has_key(self, key):
+        return key in self._fields
+
+    __contains__ = has_key
+
+    def __setitem__(self, key, val):
+        if not key in self._fields:
+            raise KeyError, str(key) + " not in store keys"
+        object.__setattr__(self, key, val)
+        if self._changes is not None:
+            self._changes.add(self._key)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict( *args, **kwargs ).iteritems():
+            self[k] = v
+
+    def __getstate__(self):
+        return self.values()
+
+    def __setstate__(self, values):
+        for k, v in zip( MOVIE_KEYS, values ):
+            object.__setattr__(self, k, v)
+        self._key, self._changes = None, None
+
+    def __repr__(self):
+        return "movie_record(%r)" % dict( self.iteritems() )
+
+
+# ********** SQLITE CACHE STORAGE ********************************************
+# cache_path and cache_hash are stored in a sqlite database, each one in its
+# own table. sqlite_table gives them the same access pattern as the former
+# pickled store (has_key, keys, iteritems, [] ...), but rows are only read
+# when first accessed, and only changed rows are written back.
+
+# cache.db: metadata, shared by all libraries
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    root                TEXT PRIMARY KEY,
+    filename            TEXT UNIQUE );
+
+CREATE TABLE IF NOT EXISTS hashs (
+    hash                TEXT PRIMARY KEY,
+    m_id                TEXT,
+    m_canonical_title   TEXT,
+    bytesize            INTEGER,
+    data                BLOB );
+CREATE INDEX IF NOT EXISTS hashs_m_id ON hashs (m_id);
+CREATE INDEX IF NOT EXISTS hashs_m_canonical_title
+    ON hashs (m_canonical_title);
+
+CREATE TABLE IF NOT EXISTS lines (
+    hash                TEXT PRIMARY KEY,
+    short               BLOB,
+    long                BLOB,
+    very_long           BLOB );
+"""
+
+# cache.db: filters index (genre, cast, director and countries terms),
+# created once filled from existing movies
+TERMS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS terms (
+    field               TEXT NOT NULL,
+    term                TEXT NOT NULL,
+    hash                TEXT NOT NULL,
+    PRIMARY KEY (field, term, hash) ) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS terms_hash ON terms (hash);
+"""
+
+# listing modes (default, -l, -L), pre-rendered lines of movies being
+# kept in the lines table, with FILENAME_MARK in place of the filename
+DISPLAY_MODES = ('short', 'long', 'very_long')
+FILENAME_MARK = '\0'
+
+# shards/*.db: paths of one library root
+PATHS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS paths (
+    path                TEXT PRIMARY KEY,
+    hash                TEXT NOT NULL,
+    last_update         REAL );
+CREATE INDEX IF NOT EXISTS paths_hash ON paths (hash);
+"""
+
+# cache.db user_version, once pickled caches of lm v0.4 are imported
+CACHE_VERSION = 1
+
+# max number of sqlite parameters in one query
+SQLITE_CHUNK = 500
+
+# changes are appended to the cache journal (write-ahead log, cache.db-wal),
+# replayed by sqlite when the cache is opened, and compacted into cache.db
+# every CACHE_CHECKPOINT_PAGES pages of journal, or when lm exits
+CACHE_CHECKPOINT_PAGES = 1000
+
+def open_cache_db( filename, schema ):
+    db = sqlite3.connect( filename )
+    db.execute( "PRAGMA journal_mode = WAL" )
+    db.execute( "PRAGMA synchronous = NORMAL" )
+    db.execute( "PRAGMA wal_autocheckpoint = %d" % CACHE_CHECKPOINT_PAGES )
+    db.executescript( schema )
+    return db
+
+def close_cache_db( db ):
+    # compact the journal into the database
+    db.execute( "PRAGMA wal_checkpoint(TRUNCATE)" )
+    db.close()
+
+class sqlite_table(object):
+    # dict-like view on a sqlite table. Values are decoded from rows
+    # on first access and kept in memory. flush() writes the changed
+    # rows in current transaction, commit is left to the caller.
+    # As store, an unknown key returns None.
+    # Subclasses set table, key and columns, and define
+    # _decode(key, row), value of a row of columns, and _encode(value),
+    # the row of columns of a value.
+
+    table   = None
+    key     = None
+    columns = ()
+
+    def __init__(self, db):
+        self.db       = db
+        self._rows    = {}      # key -> value, None for missing keys
+        self._dirty   = set()   # keys set or deleted since last flush
+
+        self._select  = "SELECT %s, %s FROM %s" % ( self.key,
+                ", ".join(self.columns), self.table )
+        self._replace = "INSERT OR REPLACE INTO %s (%s, %s) VALUES (%s)" % (
+                self.table, self.key, ", ".join(self.columns),
+                ", ".join( ["?"]*(len(self.columns)+1) ) )
+        self._delete  = "DELETE FROM %s WHERE %s = ?" % (self.table,self.key)
+
+    # a None key is stored as an empty string
+    @staticmethod
+    def _db_key( key ):
+        return u'' if key is None else key
+
+    @staticmethod
+    def _py_key( key ):
+        return None if key == u'' else key
+
+    def _loaded(self, row):
+        # called with each row read from database
+        key = self._py_key( row[0] )
+        self._rows[key] = self._decode( key, row[1:] )
+        return key
+
+    def prefetch(self, keys):
+    # read rows of a list of keys in a few queries
+        keys = [ k for k in set(keys) if not k in self._rows ]
+        for i in range(0, len(keys), SQLITE_CHUNK):
+            chunk = keys[i:i+SQLITE_CHUNK]
+            query = self._select + " WHERE %s IN (%s)" % ( self.key,
+                    ", ".join( ["?"]*len(chunk) ) )
+            for row in self.db.execute( query,
+                    [ self._db_key(k) for k in chunk ] ):
+                self._loaded(row)
+            for k in chunk:
+                self._rows.setdefault(k, None)
+
+    def existing(self, keys):
+    # set of keys having a value, rows not read yet are not decoded
+        keys = set(keys)
+        result = set( k for k in keys if self._rows.get(k) is not None )
+        keys = [ k for k in keys if not k in self._rows ]
+        for i in range(0, len(keys), SQLITE_CHUNK):
+            chunk = keys[i:i+SQLITE_CHUNK]
+            result.update( self._py_key(r[0]) for r in self.db.execute(
+                "SELECT %s FROM %s WHERE %s IN (%s)" % ( self.key,
+                    self.table, self.key, ", ".join( ["?"]*len(chunk) ) ),
+                [ self._db_key(k) for k in chunk ] ) )
+        return result
+
+    def __getitem__(self, key):
+        if not key in self._rows:
+            self.prefetch( [key] )
+        return self._rows[key]
+
+    def has_key(self, key):
+        return self[key] is not None
+
+    __contains__ = has_key
+
+    def __setitem__(self, key, value):
+        self._rows[key] = value
+        self._dirty.add(key)
+
+    def __delitem__(self, key):
+        if not self.has_key(key):
+            raise KeyError(key)
+        self._rows[key] = None
+        self._dirty.add(key)
+
+    def keys(self):
+        keys = set( self._py_key(r[0]) for r in self.db.execute(
+                "SELECT %s FROM %s" % (self.key, self.table) ) )
+        for k, v in self._rows.iteritems():
+            if v is None:
+                keys.discard(k)
+            else:
+                keys.add(k)
+        return list(keys)
+
+    def __len__(self):
+        return len( self.keys() )
+
+    def iteritems(self):
+    # reads the whole table
+        for row in self.db.execute( self._select ):
+            if not self._py_key(row[0]) in self._rows:
+                self._loaded(row)
+        for k, v in self._rows.items():
+            if v is not None:
+                yield k, v
+
+    def flush(self):
+    # write changed rows, returns their keys
+        changed = list(self._dirty)
+        self._dirty.clear()
+        for k in changed:
+            v = self._rows.get(k)
+            if v is None:
+                self.db.execute( self._delete, (self._db_key(k),) )
+            else:
+                self.db.execute( self._replace,
+                        (self._db_key(k),) + self._encode(v) )
+        logger.debug("%s: %d rows written" % (self.table, len(changed)))
+        return changed
+
+
+class sqlite_paths(sqlite_table):
+    # cache_path: path -> store( hash, last_update )
+
+    table   = 'paths'
+    key     = 'path'
+    columns = ('hash', 'last_update')
+
+    def _decode(self, key, row):
+        return store( {'hash':self._py_key(row[0]), 'last_update':row[1]} )
+
+    def paths_from_hash(self, h):
+    # [(path, last_update)] of paths pointing to hash h
+    # the paths_hash index is the hash -> paths reverse index: sqlite keeps
+    # it in line with every path written or deleted, so pending changes
+    # are flushed before reading it
+        if self._dirty:
+            self.flush()
+        return self.db.execute( "SELECT path, last_update FROM paths \
+                WHERE hash = ?", (self._db_key(h),) ).fetchall()
+
+    def _encode(self, value):
+        return ( self._db_key(value['hash']), value['last_update'] )
+
+
+class sharded_paths(object):
+    # cache_path, split in one sqlite database (a shard) per library
+    # root, i.e. mount point, in ~/.lm/shards. Shards are opened on first
+    # access to one of their paths: a listing only opens the shards
+    # covering its files, and keys() / iteritems() open all of them.
+    # Known roots are stored in the shards table of cache.db.
+
+    def __init__(self, db, hashs, shards_dir):
+        self.db         = db
+        self.hashs      = hashs
+        self.shards_dir = shards_dir
+        self.filenames  = dict( db.execute(
+            "SELECT root, filename FROM shards") )
+        self.shards     = {}    # root -> sqlite_paths, for opened shards
+        self._roots     = {}    # directory -> root
+
+    def _mount_point(self, d):
+        chain = []
+        while not d in self._roots and not os.path.ismount(d):
+            parent = os.path.dirname(d)
+            if parent == d:
+                break
+            chain.append(d)
+            d = parent
+        root = self._roots.get(d, d)
+        for c in chain + [d]:
+            self._roots[c] = root
+        return root
+
+    def root_of(self, path):
+    # library root of a path: its mount point, or for paths which don't
+    # exist anymore (unplugged drive), the longest known root
+        d = os.path.dirname(path)
+        if not d in self._roots:
+            if os.path.isdir(d):
+                self._mount_point(d)
+            else:
+                known = [ r for r in self.filenames if d == r or \
+                        d.startswith( os.path.join(r, u'') ) ]
+                self._roots[d] = max(known, key=len) if known else \
+                        os.path.splitdrive(d)[0] + os.sep
+        return self._roots[d]
+
+    def shard(self, root):
+        if not root in self.shards:
+            if not root in self.filenames:
+                name = alphanum( root ).replace(' ', '_') or 'root'
+                filename, i = name + '.db', 1
+                while filename in self.filenames.values():
+                    i += 1
+                    filename = '%s_%d.db' % (name, i)
+                self.db.execute( "INSERT INTO shards (root, filename) \
+                        VALUES (?, ?)", (root, filename) )
+                self.filenames[root] = filename
+
+            if not os.path.exists(self.shards_dir):
+                os.makedirs(self.shards_dir)
+            logger.info("opening cache shard of %s" % root)
+            shard = sqlite_paths( open_cache_db( os.path.join(
+                self.shards_dir, self.filenames[root] ), PATHS_SCHEMA ) )
+            self.shards[root] = shard
+            self._sync(shard)
+        return self.shards[root]
+
+    def _sync(self, shard):
+    # delete paths pointing to hashs deleted while the shard was closed
+        hashs = [ shard._py_key(r[0]) for r in shard.db.execute(
+                "SELECT DISTINCT hash FROM paths" ) ]
+        existing = self.hashs.existing( hashs )
+        for h in hashs:
+            if not h in existing:
+                for path, last_update in shard.paths_from_hash(h):
+                    del shard[path]
+
+    def _all_shards(self):
+        return [ self.shard(root) for root in self.filenames.keys() ]
+
+    def prefetch(self, keys):
+        by_root = {}
+        for k in keys:
+            by_root.setdefault( self.root_of(k), [] ).append(k)
+        for root, paths in by_root.iteritems():
+            self.shard(root).prefetch( paths )
+
+    def __getitem__(self, key):
+        return self.shard( self.root_of(key) )[key]
+
+    def has_key(self, key):
+        return self.shard( self.root_of(key) ).has_key(key)
+
+    __contains__ = has_key
+
+    def __setitem__(self, key, value):
+        self.shard( self.root_of(key) )[key] = value
+
+    def __delitem__(self, key):
+        del self.shard( self.root_of(key) )[key]
+
+    def keys(self):
+        result = []
+        for root in self.filenames.keys():
+            keys = self.shard(root).keys()
+            for k in keys:
+                self._roots.setdefault( os.path.dirname(k), root )
+            result.extend( keys )
+        return result
+
+    def __len__(self):
+        return len( self.keys() )
+
+    def iteritems(self):
+        for root in self.filenames.keys():
+            for k, v in self.shard(root).iteritems():
+                self._roots.setdefault( os.path.dirname(k), root )
+                yield k, v
+
+    def paths_from_hashs(self, hashs):
+    # paths of all shards pointing to one of hashs, without any access
+    # to the paths themselves (no stat, no mount point lookup)
+        hashs, result = [ self.hashs._db_key(h) for h in hashs ], []
+        for root in self.filenames.keys():
+            shard = self.shard(root)
+            if shard._dirty:
+                shard.flush()
+            for i in range(0, len(hashs), SQLITE_CHUNK):
+                chunk = hashs[i:i+SQLITE_CHUNK]
+                for (path,) in shard.db.execute( "SELECT path FROM paths \
+                        WHERE hash IN (%s)" % ", ".join( ["?"]*len(chunk) ),
+                        chunk ):
+                    self._roots.setdefault( os.path.dirname(path), root )
+                    result.append( path )
+        return result
+
+    def paths_from_hash(self, h):
+    # paths of opened shards pointing to hash h
+        result = []
+        for shard in self.shards.values():
+            result.extend( shard.paths_from_hash(h) )
+        return result
+
+    def flush(self):
+        changed = []
+        for shard in self.shards.values():
+            changed.extend( shard.flush() )
+        return changed
+
+    def commit(self):
+        for shard in self.shards.values():
+            shard.db.commit()
+
+    def close(self):
+        for shard in self.shards.values():
+            close_cache_db( shard.db )
+        self.shards = {}
+
+
+class sqlite_lines(sqlite_table):
+    # cache_lines: hash -> [line of each DISPLAY_MODES, None if not
+    # rendered yet], lines being utf-8 text
+
+    table   = 'lines'
+    key     = 'hash'
+    columns = DISPLAY_MODES
+
+    def _decode(self, key, row):
+        return [ str(v) if v is not None else None for v in row ]
+
+    def _encode(self, value):
+        return tuple( sqlite3.Binary(v) if v is not None else None \
+                for v in value )
+
+    def line(self, key, mode):
+        value = self[key]
+        return value[ DISPLAY_MODES.index(mode) ] if value else None
+
+    def set_line(self, key, mode, line):
+        value = self[key] or [None] * len(DISPLAY_MODES)
+        value[ DISPLAY_MODES.index(mode) ] = line
+        self[key] = value
+
+    def invalidate(self, key):
+    # drop lines of key, without reading them
+        self._rows[key] = None
+        self._dirty.add(key)
+
+
+class sqlite_hashs(sqlite_table):
+    # cache_hash: hash -> movie_record, stored as a pickled tuple of
+    # values, apart from indexed columns. Values are changed in place by
+    # callers, records report their changes to the table.
+    # Former rows, pickled dicts, are read transparently.
+
+    table   = 'hashs'
+    key     = 'hash'
+    columns = ('m_id', 'm_canonical_title', 'bytesize', 'data')
+
+    # terms index (lowercase genre, cast, director, country -> hashs),
+    # maintained when it exists: rows of hashs passed to reindex(), and
+    # of deleted hashs, are rewritten by flush()
+    terms   = False
+
+    # pre-rendered lines (sqlite_lines) of written hashs are dropped
+    lines   = None
+
+    def __init__(self, db):
+        sqlite_table.__init__( self, db )
+        self._reindex = set()
+
+    def reindex(self, key):
+        self._reindex.add(key)
+
+    def changed(self, key):
+    # True if the record of key was changed since last flush
+        return key in self._dirty
+
+    def flush(self):
+        changed = sqlite_table.flush(self)
+        if self.lines is not None:
+            for k in changed:
+                self.lines.invalidate(k)
+        if self.terms:
+            keys = self._reindex.union( k for k in changed
+                    if self._rows.get(k) is None )
+            for k in keys:
+                self.db.execute( "DELETE FROM terms WHERE hash = ?",
+                        (self._db_key(k),) )
+                value = self._rows.get(k)
+                if value is not None:
+                    self.db.executemany( "INSERT OR IGNORE INTO terms \
+                            (field, term, hash) VALUES (?, ?, ?)",
+                            self._terms( k, value ) )
+        self._reindex.clear()
+        return changed
+
+    def _terms(self, key, value):
+        for field, column in FILTER_FIELDS.iteritems():
+            for term in value[column] or []:
+                if term:
+                    yield field, term.lower(), self._db_key(key)
+
+    def hashs_with_terms(self, field, terms):
+    # set of hashs having one of terms (lowercase) in field
+        if self._dirty or self._reindex:
+            self.flush()
+        terms, result = list(terms), set()
+        for i in range(0, len(terms), SQLITE_CHUNK):
+            chunk = terms[i:i+SQLITE_CHUNK]
+            result.update( self._py_key(r[0]) for r in self.db.execute(
+                "SELECT hash FROM terms WHERE field = ? AND term IN (%s)" % \
+                        ", ".join( ["?"]*len(chunk) ), [field] + chunk ) )
+        return result
+
+    def _decode(self, key, row):
+        data = cPickle.loads( str(row[3]) )
+        if isinstance(data, dict):
+            return movie_record( data, key, self._dirty )
+        return movie_record.from_values( data, key, self._dirty )
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, movie_record):
+            value = movie_record( value )
+        value._key, value._changes = key, self._dirty
+        sqlite_table.__setitem__( self, key, value )
+
+    def _encode(self, value):
+        return ( value.m_id, value.m_canonical_title, value.bytesize,
+                sqlite3.Binary( cPickle.dumps( value.values(), 2 ) ) )
+
+    def rewrite(self):
+    # write every row again, filling columns added to the table
+        for h, data in self.db.execute(
+                "SELECT hash, data FROM hashs" ).fetchall():
+            key = self._loaded( (h, None, None, None, data) )
+            self._dirty.add( key )
+        return self.flush()
+
+    def hashs_by_size(self, low=None, high=None, strict=False):
+    # set of hashs which bytesize is between low and high (None for no
+    # bound), through the hashs_bytesize index. The record of unhashable
+    # files (None hash) is shared, and its bytesize is the one of the last
+    # stored file: it is left out
+        if self._dirty:
+            self.flush()
+        op = ('>', '<') if strict else ('>=', '<=')
+        where, args = [ "bytesize IS NOT NULL", "hash != ''" ], []
+        if low is not None:
+            where.append( "bytesize %s ?" % op[0] )
+            args.append( low )
+        if high is not None:
+            where.append( "bytesize %s ?" % op[1] )
+            args.append( high )
+        return set( self._py_key(r[0]) for r in self.db.execute(
+            "SELECT hash FROM hashs WHERE " + " AND ".join(where), args ) )
+
+    def hashs_by_m_id(self):
+    # {imdb id (int): [hash]} of movies found on IMDb, read from the m_id
+    # column only, pending changes being flushed before
+        if self._dirty:
+            self.flush()
+        result = {}
+        for h, m_id in self.db.execute( "SELECT hash, m_id FROM hashs \
+                WHERE m_id IS NOT NULL AND m_id != '000000'" ):
+            try:
+                result.setdefault( int(m_id), [] ).append( self._py_key(h) )
+            except ValueError:
+                pass
+        return result
+
+
+# ********** IMDB RESPONSES CACHE ********************************************
+# IMDb answers kept on disk: one week, 64 MiB at most
+IMDB_CACHE_TTL  = 7*24*3600
+IMDB_CACHE_SIZE = 64*1024*1024
+
+IMDB_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key     TEXT PRIMARY KEY,
+    data    BLOB NOT NULL,
+    size    INTEGER NOT NULL,
+    created REAL NOT NULL,
+    used    REAL NOT NULL );
+CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+"""
+
+def imdb_cache_key( method, *args ):
+# cache key of an IMDb call, None for calls not to be cached
+# search_movie: normalized query, get_movie: movie id
+    if method == 'search_movie' and len(args)==1:
+        query = ' '.join( alphanum( args[0] ).lower().split() )
+        return u'search:' + query if query else None
+    if method == 'get_movie' and len(args)==1:
+        try:
+            return u'movie:%07d' % int( args[0] )
+        except (TypeError, ValueError):
+            return None
+    return None
+
+class imdb_cache(object):
+    # pickled IMDb answers by key, shared by threads
+    # answers older than ttl are stale (not returned), and least recently
+    # used ones are deleted when total size exceeds size
+    # times of use are kept in memory, and written with the next answer or
+    # on close: reads don't hold a write transaction on the database
+
+    def __init__(self, filename, ttl=IMDB_CACHE_TTL, size=IMDB_CACHE_SIZE):
+        self.ttl  = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.used = {}
+        self.db   = sqlite3.connect( filename, check_same_thread=False )
+        self.db.execute( "PRAGMA journal_mode = WAL" )
+        self.db.execute( "PRAGMA synchronous = NORMAL" )
+        self.db.executescript( IMDB_CACHE_SCHEMA )
+        self.total = self.db.execute(
+                "SELECT coalesce(sum(size),0) FROM responses" ).fetchone()[0]
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute( "SELECT data,created FROM responses " \
+                    "WHERE key=?", (key,) ).fetchone()
+            if row is None:
+                return default
+            if row[1] < time.time()-self.ttl:
+                self._delete( key )
+                self.db.commit()
+                return default
+            self.used[key] = time.time()
+        try:
+            return cPickle.loads( str(row[0]) )
+        except Exception:
+            return default
+
+    def __setitem__(self, key, value):
+        try:
+            data = cPickle.dumps( value, 2 )
+        except Exception:
+            return
+        now = time.time()
+        with self.lock:
+            self._delete( key )
+            self.db.execute( "INSERT INTO responses VALUES (?,?,?,?,?)",
+                    (key, sqlite3.Binary(data), len(data), now, now) )
+            self.total += len(data)
+            self._write_used()
+            if self.total > self.size:
+                self._evict()
+            self.db.commit()
+
+    def _write_used(self):
+        self.db.executemany( "UPDATE responses SET used=? WHERE key=?",
+                [ (t, k) for k, t in self.used.iteritems() ] )
+        self.used.clear()
+
+    def _delete(self, key):
+        self.used.pop( key, None )
+        row = self.db.execute( "SELECT size FROM responses WHERE key=?",
+                (key,) ).fetchone()
+        if row:
+            self.db.execute( "DELETE FROM responses WHERE key=?", (key,) )
+            self.total -= row[0]
+
+    def _evict(self):
+    # delete stale answers, then least recently used ones, down to 90%
+    # of the size budget
+        self.db.execute( "DELETE FROM responses WHERE created<?",
+                (time.time()-self.ttl,) )
+        self.total = self.db.execute(
+                "SELECT coalesce(sum(size),0) FROM responses" ).fetchone()[0]
+        evict = []
+        for key, size in self.db.execute(
+                "SELECT key,size FROM responses ORDER BY used" ):
+            if self.total <= self.size*0.9:
+                break
+            evict.append( (key,) )
+            self.total -= size
+        self.db.executemany( "DELETE FROM responses WHERE key=?", evict )
+
+    def close(self):
+        with self.lock:
+            self._write_used()
+            self.db.commit()
+            close_cache_db( self.db )
+
+
+# ********** OFFLINE TITLE INDEX *********************************************
+# token index of IMDb titles, built from IMDb datasets files
+# (https://datasets.imdbws.com/ title.basics.tsv.gz and title.akas.tsv.gz)
+
+TITLE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS titles (
+    id      INTEGER PRIMARY KEY,
+    title   TEXT NOT NULL,
+    year    INTEGER );
+CREATE TABLE IF NOT EXISTS names (
+    id      INTEGER NOT NULL,
+    name    TEXT NOT NULL,
+    PRIMARY KEY (id, name) ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tokens (
+    token   TEXT NOT NULL,
+    id      INTEGER NOT NULL,
+    PRIMARY KEY (token, id) ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS token_counts (
+    token   TEXT PRIMARY KEY,
+    n       INTEGER NOT NULL );
+"""
+
+# episodes are not indexed
+TITLE_INDEX_SKIPPED_TYPES = set(['tvEpisode'])
+# candidates returned by a search, tokens used for it, and number of
+# titles above which a token is too common to be used
+TITLE_INDEX_CANDIDATES = 50
+TITLE_INDEX_TOKENS     = 4
+TITLE_INDEX_COMMON     = 20000
+
+def imdb_tsv( filename ):
+# rows of a gzipped IMDb dataset file, as lists of unicode fields
+# (None for '\N'), without the header
+    with gzip.open( filename ) as f:
+        f.readline()
+        for line in f:
+            yield [ None if v == '\\N' else v.decode('utf-8') for v in
+                    line.rstrip('\n').split('\t') ]
+
+def title_tokens( name ):
+    return set( alphanum( name ).lower().split() )
+
+def build_title_index( basics_fn, akas_fn, filename, log ):
+# build the title index in filename from IMDb datasets files (no network)
+# the index is built in a temporary file, replacing filename when done
+    tmp_fn = filename + '.tmp'
+    if os.path.exists(tmp_fn):
+        os.remove(tmp_fn)
+    db = sqlite3.connect( tmp_fn )
+    db.execute( "PRAGMA journal_mode = OFF" )
+    db.execute( "PRAGMA synchronous = OFF" )
+    db.executescript( TITLE_INDEX_SCHEMA )
+
+    def rows( tsv, kept ):
+        for n, row in enumerate(tsv):
+            if n % 500000 == 0:
+                log.info("title index: %d rows" % n)
+            row = kept( row )
+            if row:
+                yield row
+
+    def basics( row ):
+        if row[1] in TITLE_INDEX_SKIPPED_TYPES:
+            return None
+        year = int(row[5]) if row[5] and row[5].isdigit() else None
+        return int(row[0][2:]), row[2], year, row[3]
+
+    log.info("title index: reading %s" % basics_fn)
+    for row in rows( imdb_tsv(basics_fn), basics ):
+        db.execute( "INSERT INTO titles VALUES (?,?,?)", row[:3] )
+        db.executemany( "INSERT OR IGNORE INTO names VALUES (?,?)",
+                [ (row[0], alphanum(t).lower())
+                    for t in row[1], row[3] if t ] )
+
+    log.info("title index: reading %s" % akas_fn)
+    db.executemany( "INSERT OR IGNORE INTO names VALUES (?,?)",
+            rows( imdb_tsv(akas_fn), lambda row: row[2] and \
+                    (int(row[0][2:]), alphanum(row[2]).lower()) ) )
+    db.execute( "DELETE FROM names WHERE name='' OR " \
+            "id NOT IN (SELECT id FROM titles)" )
+
+    log.info("title index: indexing tokens")
+    db.executemany( "INSERT OR IGNORE INTO tokens VALUES (?,?)",
+            ( (token, id) for id, name in
+                db.cursor().execute( "SELECT id,name FROM names" )
+                for token in name.split() ) )
+    db.execute( "INSERT INTO token_counts SELECT token, count(*) " \
+            "FROM tokens GROUP BY token" )
+    db.commit()
+    db.close()
+    os.rename( tmp_fn, filename )
+
+class title_index(object):
+    # read access to the title index, from any thread (one sqlite
+    # connection per thread)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._local   = threading.local()
+
+    def _db(self):
+        db = getattr( self._local, 'db', None )
+        if db is None:
+            db = self._local.db = sqlite3.connect( self.filename )
+        return db
+
+    def search(self, title, year=None, limit=TITLE_INDEX_CANDIDATES):
+    # candidate movies for a guessed title, as imdb.Movie.Movie objects
+    # (title, year, and other names as akas), titles sharing most of
+    # the rarest tokens first, then titles of this year
+        db = self._db()
+        tokens = list( title_tokens(title) )
+        if not tokens:
+            return []
+
+        counts = db.execute( "SELECT token, n FROM token_counts WHERE " \
+                "token IN (%s)" % ','.join('?'*len(tokens)), tokens )
+        counts = sorted( counts, key=lambda c: c[1] )
+        used = [ t for t, n in counts if n <= TITLE_INDEX_COMMON ]
+        used = used[:TITLE_INDEX_TOKENS] or [ t for t, n in counts[:1] ]
+        if not used:
+            return []
+
+        hits = {}
+        for token in used:
+            for (id,) in db.execute( "SELECT id FROM tokens WHERE token=?",
+                    (token,) ):
+                hits[id] = hits.get(id, 0) + 1
+
+        years = {}
+        if year:
+            for id, y in self._titles( db, hits.keys(), "id,year" ):
+                years[id] = (y == year)
+        ids = sorted( hits, key=lambda id: (-hits[id], not years.get(id)) )
+        ids = ids[:limit]
+
+        names = {}
+        for id, name in self._titles( db, ids, "id,name", "names" ):
+            names.setdefault( id, [] ).append( name )
+        movies = dict( (id, imdb.Movie.Movie( movieID='%07d' % id,
+            data={'title':t, 'year':y, 'akas':[ n+'::' for n in
+                names.get(id, []) ]} ) )
+            for id, t, y in self._titles( db, ids, "id,title,year" ) )
+        return [ movies[id] for id in ids if movies.has_key(id) ]
+
+    def _titles(self, db, ids, columns, table="titles"):
+        ids = list(ids)
+        for k in range(0, len(ids), SQLITE_CHUNK):
+            chunk = ids[k:k+SQLITE_CHUNK]
+            for row in db.execute( "SELECT %s FROM %s WHERE id IN (%s)" % \
+                    (columns, table, ','.join('?'*len(chunk))), chunk ):
+                yield row
+
+
+# ********** OPENSUBTITLES SESSION *******************************************
+# OpenSubtitles tokens expire after 15 minutes without any call
+OPENSUBTITLE_TOKEN_TTL = 600
+# the time of the last call is saved with the token at most once per
+# OPENSUBTITLE_TOKEN_SAVE seconds
+OPENSUBTITLE_TOKEN_SAVE = 60
+
+class opensubtitles_session(object):
+    # One OpenSubtitles session for all calls of lm: login is done on first
+    # call, and its token is saved in token_fn, to be reused by next lm
+    # calls to the same server within OPENSUBTITLE_TOKEN_TTL seconds. An
+    # expired token ('401 Unauthorized' answer) leads to a new login.
+    # Each thread keeps its ServerProxy, which transport keeps the HTTP
+    # connection alive between calls.
+
+    def __init__(self, url, token_fn, log):
+        self.url      = url
+        self.token_fn = token_fn
+        self.log      = log
+        self.token    = None
+        self.saved    = 0
+        self.lock     = threading.Lock()
+        self._local   = threading.local()
+
+        try:
+            with open(self.token_fn) as f:
+                token, last_call, url = f.read().split()
+            if url == self.url and \
+                    time.time() - float(last_call) < OPENSUBTITLE_TOKEN_TTL:
+                self.log.debug("OpenSubtitles token reused")
+                self.token = token
+        except (IOError, ValueError):
+            pass
+
+    def _save_token(self):
+    # writes token and time of the last call, self.lock being held
+        self.saved = time.time()
+        try:
+            with open(self.token_fn,'w') as f:
+                f.write( "%s %f %s" % (self.token, self.saved, self.url) )
+        except IOError, e:
+            self.log.warning("OpenSubtitles token not saved: %s" % str(e))
+
+    def server(self):
+        server = getattr( self._local, 'server', None )
+        if server is None:
+            server = self._local.server = xmlrpclib.ServerProxy( self.url )
+        return server
+
+    def login(self, user="", password="", expired=None):
+    # returns a valid token, logging in if there is none, or if
+    # the current one is the expired one
+        with self.lock:
+            if self.token and self.token != expired:
+                return self.token
+            try:
+                log = self.server().LogIn( user, password, 'en',
+                        OPENSUBTITLE_USER_AGENT )
+            except Exception, e:
+                raise LoginError("OpenSubtitles login process DOWN: %s" % \
+                        str(e))
+
+            if not( isinstance(log, dict) and log.get('status')=="200 OK" ):
+                raise LoginError(str(log))
+
+            self.log.debug("OpenSubtitles login OK")
+            self.token = log['token']
+            self._save_token()
+            return self.token
+
+    def call(self, method, *args):
+    # XMLRPC call of method, with token as first argument
+        token = self.token or self.login()
+        ans = getattr( self.server(), method )( token, *args )
+
+        if isinstance(ans, dict) and \
+                str(ans.get('status','')).startswith('401'):
+            self.log.info("OpenSubtitles token expired, new login")
+            token = self.login( expired=token )
+            ans = getattr( self.server(), method )( token, *args )
+
+        if time.time() - self.saved > OPENSUBTITLE_TOKEN_SAVE:
+            with self.lock:
+                if time.time() - self.saved > OPENSUBTITLE_TOKEN_SAVE:
+                    self._save_token()
+        return ans
+
+    def logout(self):
+        with self.lock:
+            if self.token:
+                try:
+                    self.server().LogOut(self.token)
+                    self.log.debug("OpenSubtitles logout OK")
+                except Exception, e:
+                    self.log.warning("OpenSubtitles logout process DOWN, %s" \
+                            % str(e))
+                self.token = None
+                if os.path.exists(self.token_fn):
+                    os.remove(self.token_fn)
+
+
+# ********** HTML SUMUP ******************************************************
+# the sumup page is a static page, loading movies from data files of
+# HTML_PAGE_SIZE movies on average (JavaScript files, as browsers don't
+# read JSON files from file:// pages), and showing them by pages of
+# HTML_VIEW_SIZE movies, with filtering and sorting done by the browser
+HTML_PAGE_SIZE  = 500
+HTML_VIEW_SIZE  = 60
+# fields of movies in data files
+HTML_FIELDS     = ('file', 'imdb_id', 'title', 'year', 'rating', 'votes',
+        'genre', 'director', 'size', 'unsure', 'cover')
+
+HTML_PAGE = u"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>lm</title>
+<style>
+body { font-family: sans-serif; font-size: 13px; }
+#movies { display: flex; flex-wrap: wrap; }
+.movie { width: 200px; height: 280px; margin: 4px; overflow: hidden; }
+.movie img { height: 150px; }
+.info { color: #808080; }
+.unsure .info { color: #FF3333; }
+</style>
+</head>
+<body>
+<div>
+<input id="search" placeholder="title, genre, director, file" size=40>
+<select id="sort">
+  <option value="rating">rating</option>
+  <option value="title">title</option>
+  <option value="year">year</option>
+  <option value="votes">votes</option>
+  <option value="size">size</option>
+</select>
+<label><input id="reverse" type="checkbox"> reverse</label>
+<button id="previous">&lt;</button> <span id="page"></span>
+<button id="next">&gt;</button>
+</div>
+<div id="movies"></div>
+<script>
+var data = "%(data)s/", view_size = %(view_size)d;
+var index, pages = {}, loaded = 0, movies = [], shown = [], page = 0;
+
+function $(id) { return document.getElementById(id); }
+
+function load(src) {
+    var script = document.createElement("script");
+    script.src = src;
+    document.body.appendChild(script);
+}
+
+function lm_index(info) {
+    index = info;
+    $("sort").value = info.sort;
+    $("reverse").checked = info.reverse;
+    if (!info.pages.length) update();
+    for (var i = 0; i < info.pages.length; i++)
+        load(data + info.pages[i][0] + "?" + info.pages[i][1]);
+}
+
+function lm_page(n, rows) {
+    pages[n] = rows;
+    if (++loaded < index.pages.length) return;
+    for (var i = 0; i < index.pages.length; i++)
+        for (var j = 0; j < pages[i].length; j++) {
+            var m = {}, row = pages[i][j];
+            for (var k = 0; k < index.fields.length; k++)
+                m[index.fields[k]] = row[k];
+            m.text = [m.title, m.genre.join(" "), m.director.join(" "),
+                m.file].join(" ").toLowerCase();
+            movies.push(m);
+        }
+    update();
+}
+
+function update() {
+    var words = $("search").value.toLowerCase().split(/\\s+/);
+    var key = $("sort").value, sign = $("reverse").checked ? -1 : 1;
+    shown = movies.filter(function (m) {
+        for (var i = 0; i < words.length; i++)
+            if (m.text.indexOf(words[i]) < 0) return false;
+        return true;
+    });
+    shown.sort(function (a, b) {
+        var x = a[key], y = b[key];
+        if (x === y)
+            return a.file < b.file ? -1 : a.file > b.file ? 1 : 0;
+        if (x === null) return -sign;
+        if (y === null) return sign;
+        return (x < y ? -1 : 1) * sign;
+    });
+    page = 0;
+    show();
+}
+
+function cell(tag, parent, text) {
+    var e = document.createElement(tag);
+    if (text !== undefined) e.appendChild(document.createTextNode(text));
+    parent.appendChild(e);
+    return e;
+}
+
+function show() {
+    var pages_nb = Math.max(1, Math.ceil(shown.length / view_size));
+    page = Math.min(Math.max(page, 0), pages_nb - 1);
+    $("page").textContent = (page + 1) + "/" + pages_nb + " (" +
+        shown.length + " movies)";
+    var list = $("movies");
+    list.innerHTML = "";
+    shown.slice(page * view_size, (page + 1) * view_size).forEach(
+        function (m) {
+            var div = cell("div", list);
+            div.className = m.unsure ? "movie unsure" : "movie";
+            var a = cell("a", div, m.title);
+            a.href = "http://www.imdb.com/title/tt" + m.imdb_id + "/";
+            var info = cell("div", div, m.genre.slice(0, 2).join(", "));
+            info.className = "info";
+            cell("div", info, "note: " + m.rating + ", votes: " +
+                (m.votes ? (m.votes / 1000).toFixed(1) + "K" : "None"));
+            cell("div", info, "size: " + m.size + "Mo");
+            a = cell("a", div);
+            a.href = "http://www.youtube.com/results?search_query=" +
+                encodeURIComponent(m.title + " trailer");
+            if (m.cover) cell("img", a).src = m.cover;
+            cell("div", div, m.file.slice(0, 20)).style.fontSize = "smaller";
+        });
+}
+
+$("search").oninput = $("sort").onchange = $("reverse").onchange = update;
+$("previous").onclick = function () { page--; show(); };
+$("next").onclick = function () { page++; show(); };
+load(data + "index.js?" + new Date().getTime());
+</script>
+</body>
+</html>
+"""
+
+def write_file( filename, data ):
+# writes data to filename through a temporary file, so that readers
+# never see a partly written file
+    tmp_fn = filename + '.tmp'
+    with open( tmp_fn, 'wb' ) as f:
+        f.write( data )
+    os.rename( tmp_fn, filename )
+
 # ********** MAIN CLASS ******************************************************
 class ListMovies():
 
     order_alpha     = False
     order_reverse   = False
+    limit           = None
     filter_phrase   = None
+    filter_dict     = None
 
     disp_long       = False
     disp_very_long  = False
     disp_outline    = False
+    out_format      = None
+
+    rescan          = False
+
+    # hashing threads, in total and per device (disk)
+    jobs            = 4
+    device_jobs     = 2
+    # IMDb requests threads
+    imdb_jobs       = 4
+    # OpenSubtitles server, requests threads, and hashs per request
+    opensubtitles_url   = OPENSUBTITLE_DOMAIN
+    opensubtitles_jobs  = 4
+    opensubtitles_batch = OPENSUBTITLE_BATCH
 
     def __init__( self, options=None, level=logging.ERROR ):
 
         if options:
             self.order_alpha = options.alphabetical
             self.order_reverse = options.reverse
+            self.limit = options.limit
             self.filter_phrase = options.filter
             self.filter_dict = options.filter_dict if options.filter else None
             self.disp_long = options.long
             self.disp_very_long = options.very_long
             self.disp_outline = options.outline
+            self.out_format = options.format
+            self.rescan = options.rescan
+            self.jobs = max(1, options.jobs)
+            self.device_jobs = max(1, options.device_jobs)
+            self.imdb_jobs = max(1, options.imdb_jobs)
+            self.opensubtitles_url = options.opensubtitles_url
+            self.opensubtitles_jobs = max(1, options.opensubtitles_jobs)
+            self.opensubtitles_batch = min( OPENSUBTITLE_BATCH,
+                    max(1, options.opensubtitles_batch) )
 
         self.log = logging.getLogger("LM")
         self.log.addHandler( NullHandler() )
@@ -382,20 +1913,38 @@ class ListMovies():
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
 
+        self.cache_db_fn   = os.path.join( cache_dir, 'cache.db')
+        self.shards_dir    = os.path.join( cache_dir, 'shards')
+        # former pickled caches, only used for migration
         self.cache_path_fn = os.path.join( cache_dir, 'cache_path')
         self.cache_hash_fn = os.path.join( cache_dir, 'cache_hash')
+        self.cache_dirs_fn = os.path.join( cache_dir, 'cache_dirs')
 
         # html output sumup file
         self.html_fn  = os.path.join( cache_dir, 'html_sumup.html')
+        self.html_dir = os.path.join( cache_dir, 'html_sumup')
+
+        # FileEntry records of files found by get_files, by path
+        self.file_entries = {}
 
-        self.load_cache_path()
-        self.load_cache_hash()
+        # directory manifest, to skip listing of unchanged directories
+        self.load_cache_dirs()
 
-        self.i = imdb.IMDb()
+        # IMDb objects of worker threads, their common rate limit, and
+        # the cache of their answers
+        self.imdb_local   = threading.local()
+        self.imdb_limiter = rate_limiter( IMDB_RATE )
+        self.imdb_cache_fn = os.path.join( cache_dir, 'imdb_cache.db')
+        self.imdb_cache   = imdb_cache( self.imdb_cache_fn )
 
-        # opensubtitles XMLRPC server and tokern
-        self.server = None
-        self.token  = None
+        # offline title index, if built (see build_title_index)
+        self.title_index_fn = os.path.join( cache_dir, 'title_index.db')
+        self.title_index  = title_index( self.title_index_fn ) \
+                if os.path.exists( self.title_index_fn ) else None
+
+        # opensubtitles XMLRPC session
+        self.opensubtitles = opensubtitles_session( self.opensubtitles_url,
+                os.path.join( cache_dir, 'opensubtitles_token' ), self.log )
 
         # terminal coloration
         self.RED    = "\033[00;31m"
@@ -420,93 +1969,166 @@ class ListMovies():
                      '.wmv','.wmx','.wrap','.wvx','.wx','.x264','.xvid']
         self.file_ext = [ unicode(ext) for ext in self.file_ext ]
 
-        self.forbidden_words = ['divx','dvdrip','xvid','ts','dvdscr',
-                     'cam','dvdscr','xvid','aac','r5']
-
-        self.default_hash = {
-            'bytesize'            : None,
-            'imdb_check'          : 0,
-            'm_id'                : None,
-            'm_title'             : None,
-            'm_canonical_title'   : None,
-            'm_rating'            : None,
-            'm_year'              : None,
-            'm_genre'             : None,
-            'm_countries'         : None,
-            'm_director'          : None,
-            'm_short_summary'     : None,
-            'm_summary'           : None,
-            'm_cast'              : None,
-            'm_votes'             : None,
-            'm_cover'             : None,
-            'm_last_update'       : None,
-            'o_imdb_id'           : None,
-            'o_year'              : None,
-            'o_check'             : 0,
-            'o_title'             : None,
-            'g_title'             : None,
-            'g_year'              : None,
-            'g_unsure'            : False
-        }
+        self.forbidden_words = FORBIDDEN_WORDS
 
         self.default_path = {
             'hash'          : None,
             'last_update'   : 0
             }
 
+        self.load_cache()
+
     # ********** CACHE HANDLERS **********************************************
-    def load_cache_path(self):
-        self.log.info("loading cache_path")
+    def load_cache(self):
+    # open the sqlite cache, migrating former pickled caches
+    # (cache_path and cache_hash files) on first call
+        self.log.info("loading cache")
+        self.cache_db   = open_cache_db( self.cache_db_fn, CACHE_SCHEMA )
+        self.cache_hash = sqlite_hashs( self.cache_db )
+        self.cache_lines = sqlite_lines( self.cache_db )
+        self.cache_hash.lines = self.cache_lines
+        self._migrate_bytesize_column()
+        self.cache_path = sharded_paths( self.cache_db, self.cache_hash,
+                self.shards_dir )
+
+        # user_version is set once pickled caches are migrated (or
+        # there was none), a failed migration is tried again next time
+        if self.cache_db.execute( "PRAGMA user_version" ).fetchone()[0] \
+                < CACHE_VERSION and self._migrate_pickles():
+            self.cache_db.execute( "PRAGMA user_version = %d" % \
+                    CACHE_VERSION )
+            self.cache_db.commit()
+        self._migrate_paths_table()
+        self._migrate_terms_table()
+
+    def close_cache(self):
+    # save caches, and compact the journals into the databases
+        self.save_cache()
+        self.cache_path.close()
+        close_cache_db( self.cache_db )
+        self.imdb_cache.close()
+
+    def _migrate_paths_table(self):
+    # paths were stored in cache.db before being split in shards
+        if not self.cache_db.execute( "SELECT name FROM sqlite_master \
+                WHERE type = 'table' AND name = 'paths'" ).fetchall():
+            return
+
+        self.log.info("moving cache paths to shards")
+        for path, h, last_update in self.cache_db.execute(
+                "SELECT path, hash, last_update FROM paths" ).fetchall():
+            self.cache_path[path] = store( {'hash':h or None,
+                'last_update':last_update} )
+        self.cache_db.execute( "DROP TABLE paths" )
+        self.save_cache()
+
+    def _migrate_bytesize_column(self):
+    # bytesize of hashs is also stored in an indexed column, for size
+    # filters (added to existing caches, and filled once)
+        columns = [ c[1] for c in self.cache_db.execute(
+            "PRAGMA table_info(hashs)" ) ]
+        if not 'bytesize' in columns:
+            self.log.info("adding size column to cache")
+            self.cache_db.execute( "ALTER TABLE hashs ADD COLUMN \
+                    bytesize INTEGER" )
+            self.cache_hash.rewrite()
+        self.cache_db.execute( "CREATE INDEX IF NOT EXISTS hashs_bytesize \
+                ON hashs (bytesize)" )
+        self.cache_db.commit()
+
+    def _migrate_terms_table(self):
+    # terms index of filters, built once from existing movies
+        self.cache_hash.terms = True
+        if self.cache_db.execute( "SELECT name FROM sqlite_master \
+                WHERE type = 'table' AND name = 'terms'" ).fetchall():
+            return
+
+        self.log.info("building filters index")
+        self.cache_db.executescript( TERMS_SCHEMA )
+        for h, v in self.cache_hash.iteritems():
+            self.cache_hash.reindex(h)
+        self.save_cache()
+
+    def _migrate_pickles(self):
+    # one shot import of pickled caches into the sqlite cache
+    # pickled files are then renamed with a '.old' suffix
+    # returns False if the migration failed
+        if not( os.path.exists(self.cache_path_fn) and \
+                os.path.exists(self.cache_hash_fn) ):
+            return True
+
+        self.log.info("migrating pickled caches to sqlite")
         try:
-            with open(self.cache_path_fn,'r') as f:
-                self.cache_path = cPickle.load(f)
-            self.log.info("cache_path file loaded successfully")
-        except:
-            self.log.debug("cache_path not loaded ->  empty initilazation")
-            self.cache_path = store()
-            self.cache_path.static = False
-
-    def _save_cache_path(self):
-        self.log.info("saving cache_path")
-        with open(self.cache_path_fn,'w') as f:
-            cPickle.dump(self.cache_path,f)
-        self.log.info("cache_path saved")
-
-    def load_cache_hash(self):
-        self.log.info("loading cache_hash")
+            with open(self.cache_path_fn,'rb') as f:
+                cache_path = cPickle.load(f)
+            with open(self.cache_hash_fn,'rb') as f:
+                cache_hash = cPickle.load(f)
+        except Exception, e:
+            self.log.error("pickled caches not migrated: %s" % str(e))
+            return False
+
+        for k, v in cache_hash.iteritems():
+            self.cache_hash[k] = v
+        for k, v in cache_path.iteritems():
+            self.cache_path[k] = store( self.default_path )
+            self.cache_path[k].update( v )
+        self.save_cache()
+
+        for fn in [ self.cache_path_fn, self.cache_hash_fn ]:
+            os.rename( fn, fn + '.old' )
+        self.log.info("%d paths and %d hashs migrated" % ( len(cache_path),
+                len(cache_hash) ))
+        return True
+
+    def load_cache_dirs(self):
+    # directory manifest: { dir: (mtime, paths of files, subdirs) }
+    # the manifest is dropped when its layout changes
+        self.log.info("loading cache_dirs")
         try:
-            with open(self.cache_hash_fn,'r') as f:
-                self.cache_hash = cPickle.load(f)
-            self.log.info("cache_hash file loaded successfully")
+            with open(self.cache_dirs_fn,'rb') as f:
+                fields, self.cache_dirs = cPickle.load(f)
+            if fields != CACHE_DIRS_LAYOUT:
+                raise ValueError("outdated cache_dirs format")
+            self.log.info("cache_dirs file loaded successfully")
         except:
-            self.log.debug("cache_hash not loaded ->  empty initilazation")
-            self.cache_hash = store()
-            self.cache_hash.static = False
-
-    def _save_cache_hash(self):
-        self.log.info("saving cache_hash")
-        with open(self.cache_hash_fn,'w') as f:
-            cPickle.dump(self.cache_hash,f)
-        self.log.info("cache_hash saved")
+            self.log.debug("cache_dirs not loaded ->  empty initilazation")
+            self.cache_dirs = {}
+        self.cache_dirs_changed = False
+
+    def save_cache_dirs(self):
+        if self.cache_dirs_changed:
+            self.log.info("saving cache_dirs")
+            with open(self.cache_dirs_fn,'wb') as f:
+                cPickle.dump( (CACHE_DIRS_LAYOUT, self.cache_dirs), f,
+                        cPickle.HIGHEST_PROTOCOL)
+            self.cache_dirs_changed = False
+            self.log.info("cache_dirs saved")
 
     def _sync_cache(self):
     # delete self.cache_path items pointing whose hash isnt pointing
     # to an self.cache_hash key
+    # i.e. paths of deleted hashs, in opened shards (other shards are
+    # synchronized when opened, see sharded_paths.shard)
         self.log.info("synchronizing caches")
-        files = [ f for f, v in self.cache_path.iteritems() if \
-                    not self.cache_hash.has_key(v['hash']) ]
-        for f in files:
-            del self.cache_path[f]
+        deleted = [ h for h in self.cache_hash.flush() \
+                if not self.cache_hash.has_key(h) ]
+        for h in deleted:
+            for f, last_update in self.cache_path.paths_from_hash(h):
+                del self.cache_path[f]
 
     def save_cache(self):
     # save cache function
     # save both at same time, after 'consistency' check:
     # every path from cache_path should point to an hash in cache_hash
+    # only changed rows are written, in one transaction
 
         self.log.info("saving caches")
         self._sync_cache()
-        self._save_cache_path()
-        self._save_cache_hash()
+        self.cache_path.flush()
+        self.cache_hash.flush()
+        self.cache_lines.flush()
+        self.cache_path.commit()
+        self.cache_db.commit()
 
     def delete_cache( self, files ):
     # delete a list of files in cache
@@ -538,15 +2160,58 @@ class ListMovies():
         else:
             print("no file to delete")
 
+    def build_title_index(self, basics_fn, akas_fn):
+        print( "building title index, it may take a while..." )
+        build_title_index( basics_fn, akas_fn, self.title_index_fn, self.log )
+        self.title_index = title_index( self.title_index_fn )
+        print( "title index built: %s" % self.title_index_fn )
+
+    def refresh_ratings(self, ratings_fn):
+    # update m_rating and m_votes of every cached movie, in one pass on
+    # IMDb datasets file title.ratings.tsv.gz (no network)
+        cache = self.cache_hash
+        by_id = cache.hashs_by_m_id()
+
+        ratings = {}
+        for row in imdb_tsv( ratings_fn ):
+            id = int( row[0][2:] )
+            if by_id.has_key(id):
+                ratings[id] = ( float(row[1]), int(row[2]) )
+
+        cache.prefetch( [ h for id in ratings for h in by_id[id] ] )
+        changed = 0
+        for id, (rating, votes) in ratings.iteritems():
+            for h in by_id[id]:
+                if cache[h]['m_rating'] != rating or \
+                        cache[h]['m_votes'] != votes:
+                    cache[h].update( {'m_rating':rating, 'm_votes':votes} )
+                    changed += 1
+        self.save_cache()
+        print( "ratings: %d of %d cached movies found in %s, %d movies " \
+                "updated" % (len(ratings), len(by_id), ratings_fn, changed) )
+
     def reset_cache_files(self):
         confirm = boolean_input("Confirm cache files deletion?")
         if confirm:
+            self.cache_db.close()
+            self.imdb_cache.close()
+            for fn in [self.cache_db_fn, self.imdb_cache_fn]:
+                for suffix in ['', '-wal', '-shm']:
+                    if os.path.exists(fn + suffix):
+                        os.remove(fn + suffix)
+            if os.path.exists(self.shards_dir):
+                shutil.rmtree(self.shards_dir)
             if os.path.exists(self.cache_path_fn):
                 os.remove(self.cache_path_fn)
             if os.path.exists(self.cache_hash_fn):
                 os.remove(self.cache_hash_fn)
+            if os.path.exists(self.cache_dirs_fn):
+                os.remove(self.cache_dirs_fn)
             if os.path.exists(self.html_fn):
                 os.remove(self.html_fn)
+            if os.path.exists(self.html_dir):
+                shutil.rmtree(self.html_dir)
+            self.opensubtitles.logout()
 
     #
     def flush_out_str(self, out_str):
@@ -571,66 +2236,144 @@ class ListMovies():
     # i.e. if you modified you file after your last 'lm' call
     # 'lm' will re-hash your file
     # if hash error, None is stored in cache
+    # size and mtime come from the FileEntry records of get_files()
+    # files are hashed by a pool of threads (see hash_files), cache
+    # updates being done here, in the main thread
 
         cache_path = self.cache_path
         cache_hash = self.cache_hash
+        to_hash    = []
+        cache_path.prefetch( abs_paths )
         for path in abs_paths:
 
-            if not( cache_path.has_key(path) and \
-                    os.path.getmtime(path) < cache_path[path]['last_update']):
+            entry = self.file_entries.get(path) or file_entry(path)
+            if not entry:
+                self.log.warning("can't stat file: %s" % path)
+                continue
+
+            if not self._is_cached( entry ):
+                to_hash.append(entry)
 
-                self.log.info("adding new path to cache: %s" % path)
-                cur_hash = hashFile(path)
+        for entry, cur_hash in self.hash_files(to_hash):
+            self._cache_hashed( entry, cur_hash )
 
-                if cur_hash in ['SizeError','IOError']: cur_hash = None
-                cache_path[path] = store( self.default_path )
-                cache_path[path].update( {'hash':cur_hash,
-                                   'last_update':time.time() } )
+        self.save_cache()
 
-                # setting default keys.values in cache
-                if not cache_hash.has_key(cur_hash):
-                    self.log.debug("adding hash entry %s for file: %s" % ( \
-                            str(cur_hash), path ) )
+    def _is_cached( self, entry ):
+    # True if the path of a FileEntry is cached, and not modified since
+        path = entry.path
+        return self.cache_path.has_key(path) and \
+                entry.mtime < self.cache_path[path]['last_update'] and \
+                self.cache_hash.has_key(self.cache_path[path]['hash'])
 
-                    cache_hash[cur_hash] = store( self.default_hash )
-                    cache_hash[cur_hash]['bytesize'] = os.path.getsize(path)
+    def _cache_hashed( self, entry, cur_hash ):
+    # writes a hashed FileEntry in caches, returns its hash (None if
+    # the file couldn't be hashed)
+        cache_path = self.cache_path
+        cache_hash = self.cache_hash
+        path = entry.path
+        self.log.info("adding new path to cache: %s" % path)
+
+        if cur_hash in ['SizeError','IOError']: cur_hash = None
+        path_info = store( self.default_path )
+        path_info.update( {'hash':cur_hash, 'last_update':time.time()} )
+        cache_path[path] = path_info
+
+        # setting default keys.values in cache
+        if not cache_hash.has_key(cur_hash):
+            self.log.debug("adding hash entry %s for file: %s" % ( \
+                    str(cur_hash), path ) )
+
+            cache_hash[cur_hash] = movie_record()
+            cache_hash[cur_hash]['bytesize'] = entry.size
+            self.cache_lines.invalidate( cur_hash )
+        return cur_hash
+
+    def hash_files( self, entries ):
+    # Yields (entry, hash) for a list of FileEntry, in completion order
+    # Up to self.jobs files are hashed at the same time, but no more than
+    # self.device_jobs per device, not to make a spinning disk thrash
+        if self.jobs == 1 or len(entries) < 2:
+            for entry in entries:
+                yield entry, hashFile(entry.path, entry.size)
+            return
 
-        self.save_cache()
+        devices = {}
+        for entry in entries:
+            devices.setdefault(entry.device, []).append(entry)
+        locks = dict( (d, threading.BoundedSemaphore(self.device_jobs)) \
+                for d in devices )
 
-    def update_cache_hash_opensubtitles(self):
-    # Update cache_hash opensubtitles info
+        # round robin on devices, so that threads don't all wait for
+        # the same disk
+        entries = [ e for group in izip_longest( *devices.values() ) \
+                for e in group if e ]
+
+        def hash_entry( entry ):
+            with locks[entry.device]:
+                return entry, hashFile(entry.path, entry.size)
+
+        self.log.info("hashing %d files, %d jobs" % (len(entries),self.jobs))
+        pool = ThreadPool( min(self.jobs, len(entries)) )
+        try:
+            for result in pool.imap_unordered( hash_entry, entries ):
+                yield result
+        finally:
+            pool.terminate()
+
+    def hashs_from_paths( self, files ):
+    # distinct hashs pointed by a list of cached files
+    # (path and hash rows are read in one go)
+        self.cache_path.prefetch( files )
+        hashs, seen = [], set()
+        for f in files:
+            if self.cache_path.has_key(f):
+                h = self.cache_path[f]['hash']
+                if not h in seen:
+                    seen.add(h)
+                    hashs.append(h)
+        self.cache_hash.prefetch( hashs )
+        return [ h for h in hashs if self.cache_hash.has_key(h) ]
+
+    def update_cache_hash_opensubtitles(self, files):
+    # Update cache_hash opensubtitles info, for hashs of files
     # For movies which hash was not found in opensubtitles, will be tried
     # again only 6 hours after
 
-        cache = self.cache_hash
-        hashs = [ h for h in cache.keys() if h and
-            not cache[h]['o_title'] and \
-                 cache[h]['o_check'] < time.time()-3600*6 ]
+        hashs = [ h for h in self.hashs_from_paths(files)
+                if self._to_check_opensubtitles(h) ]
 
         data = self.get_info_from_opensubtitles( hashs )
 
-        for h in hashs:
-
-            now = time.time()
-            cache[h]['o_check'] = now
-
-            if data.has_key(h):
-                info = data[h]
-                if info:
-                    try:
-                        open_info = {'o_imdb_id':info['MovieImdbID'],
-                                       'o_title':info['MovieName'],
-                                        'o_year':info['MovieYear']}
-                        cache[h].update( open_info )
-
-                    except:
-                        self.log.debug("faild to update (%s) open info" +\
-                                " with open answer %s " % (str(h),str(info)) )
-                        pass
+        # hashs of failed requests are not in data: tried again next time
+        for h in [ h for h in hashs if data.has_key(h) ]:
+            self._set_opensubtitles_info( h, data[h] )
 
         if len(hashs)>0:
             self.save_cache()
 
+    def _to_check_opensubtitles(self, h):
+        cache = self.cache_hash
+        return bool(h) and not cache[h]['o_title'] and \
+                cache[h]['o_check'] < time.time()-3600*6
+
+    def _set_opensubtitles_info(self, h, info):
+    # writes the CheckMovieHash answer of a hash (None if unknown)
+        cache = self.cache_hash
+        cache[h]['o_check'] = time.time()
+
+        if info:
+            try:
+                open_info = {'o_imdb_id':info['MovieImdbID'],
+                               'o_title':info['MovieName'],
+                                'o_year':info['MovieYear']}
+                cache[h].update( open_info )
+
+            except:
+                self.log.debug("faild to update (%s) open info" +\
+                        " with open answer %s " % (str(h),str(info)) )
+                pass
+
     # *********** OPENSUBTITLES CONNECTIONS **********************************
     def status_ok(self, ans):
         status = False
@@ -647,58 +2390,108 @@ class ListMovies():
         finally:
             return( status )
 
-    def login(self, user="", password=""):
-        try:
-            server = xmlrpclib.ServerProxy(OPENSUBTITLE_DOMAIN)
-            log    = server.LogIn(user,password,'en',OPENSUBTITLE_USER_AGENT)
-
-            if self.status_ok(log):
-                self.log.debug("OpenSubtitles login OK")
-                self.server = server
-                self.token  = log['token']
-            else:
-                raise LoginError(str(log))
-
-        except LoginError, e:
-            self.log.warning( str(e)  )
-
-        except Exception, e:
-            self.log.error("OpenSubtitles login process DOWN: %s" % str(e))
-
-
-    def logout(self):
-        if self.token:
-            try:
-                self.server.LogOut(self.token)
-                self.log.debug("OpenSubtitles logout OK")
-            except Exception, e:
-                self.log.warning("OpenSubtitles logout process DOWN, %s" % \
-                        str(e))
-
     # retrive general info for a list of movie hash
+    # -> {hash: info}, info being None for hashs unknown by opensubtitles,
+    # hashs of failed requests are missing
     def get_info_from_opensubtitles( self, hashs ):
             data = {}
 
             if len(hashs)>0:
-                self.log.info("request OpenSubtitle info for %d hashes" %\
-                        len(hashs))
+                size = self.opensubtitles_batch
+                batches = [ hashs[k:k+size]
+                        for k in range(0, len(hashs), size) ]
+                self.log.info("request OpenSubtitle info for %d hashes, " \
+                        "in %d requests" % (len(hashs), len(batches)) )
+
+                start = time.time()
+                latencies, retries, failed = [], 0, 0
+                pool = ThreadPool( min(self.opensubtitles_jobs,
+                    len(batches)) )
                 try:
-                    self.login()
-                    for k in range( len(hashs)/150+1 ):
-                        res = self.server.CheckMovieHash( self.token,
-                                hashs[150*k:(150*(k+1))] )
-                        data.update( res['data'] )
-                    self.logout()
-                except LoginError:
-                    self.log.debug("Error when retrieving hash " + \
-                            "from opensubtitles")
-                    pass
-
-                for k, v in data.iteritems():
-                    if len(v)==0: data[k]=None
+                    for found, latency, attempts, error in \
+                            pool.imap_unordered(
+                                    self._check_hash_batch, batches ):
+                        data.update( found )
+                        latencies.append( latency )
+                        retries += attempts-1
+                        if error:
+                            failed += 1
+                            self.log.error("OpenSubtitles request failed " \
+                                    "for %d hashs (%s): %s" % (len(error[0]),
+                                        ", ".join(error[0]), error[1]))
+                finally:
+                    pool.terminate()
+
+                elapsed = max( time.time()-start, 1e-6 )
+                stats = "OpenSubtitles: %d/%d hashs checked in " \
+                        "%.1fs (%.1f hashs/s), %d requests (latency " \
+                        "min/avg/max: %.2f/%.2f/%.2fs), %d retries, " \
+                        "%d failed" % ( len(data), len(hashs), elapsed,
+                            len(data)/elapsed, len(batches),
+                            min(latencies),
+                            sum(latencies)/len(latencies),
+                            max(latencies), retries, failed )
+                # shown without --debug when some requests went wrong, on
+                # stderr not to mix with a --format listing
+                if retries or failed:
+                    sys.stderr.write( stats + "\n" )
+                else:
+                    self.log.info( stats )
 
             return(data)
 
+    def _check_hash_batch( self, batch ):
+    # CheckMovieHash request for a batch of hashs, in a worker thread
+    # answers of a failed attempt are kept, and only missing hashs
+    # are requested again. A login error is retried once, with a new
+    # login (unless another thread got a new token meanwhile)
+    # -> (found, latency, attempts, error) where found is {hash: info},
+    # latency of the last attempt, error (missing hashs, message)
+
+        found, remaining = {}, list(batch)
+        latency, error = 0., None
+        expired, relogged = None, False
+        for attempt in range(OPENSUBTITLE_RETRIES+1):
+            start = time.time()
+            try:
+                if expired is not None:
+                    self.opensubtitles.login( expired=expired )
+                    expired = None
+                res = self.opensubtitles.call( 'CheckMovieHash', remaining )
+                answered = res.get('data') if isinstance(res, dict) else None
+                if isinstance(answered, dict):
+                    for h, info in answered.iteritems():
+                        found[h] = info or None
+                if not self.status_ok(res):
+                    raise OpensubtitlesError( str(res.get('status')) \
+                            if isinstance(res, dict) else str(res) )
+                # answer OK: hashs not in answer are unknown
+                for h in remaining:
+                    found.setdefault( h, None )
+                remaining = []
+            except LoginError, e:
+                error = str(e)
+                latency = time.time()-start
+                if relogged:
+                    break
+                relogged, expired = True, self.opensubtitles.token or ''
+            except Exception, e:
+                error = str(e)
+                remaining = [ h for h in remaining if not found.has_key(h) ]
+            latency = time.time()-start
+
+            if not remaining:
+                error = None
+                break
+            if attempt < OPENSUBTITLE_RETRIES:
+                delay = OPENSUBTITLE_BACKOFF * 2**attempt
+                self.log.warning("OpenSubtitles request failed (%s), " \
+                        "retry in %is" % (error, delay))
+                time.sleep( delay )
+
+        return( found, latency, attempt+1, (remaining, error) \
+                if error else None )
+
     def path_from_hash(self, cur_hash):
     # Returns the lastest modified file in cache_path pointing to this hash
     # a path points to 1 hash only
@@ -706,22 +2499,27 @@ class ListMovies():
     # [cache_path] * ----> 1 [cache_hash]
     # return a dictionary, 'path', 'cache_time', 'file_time'
 
-        path = [ (k,v['last_update']) for k,v in self.cache_path.iteritems() \
-                if v['hash'] == cur_hash and os.path.exists(k) ]
+    # paths are looked up through the hash -> paths index of cache_path,
+    # files found by get_files are known to exist without a stat
+
+        entries = self.file_entries
+        path = [ (k,t) for k,t in self.cache_path.paths_from_hash(cur_hash) \
+                if k in entries or os.path.exists(k) ]
 
         if len(path)>0:
             update_time = [ k[1] for k in path ]
             max_update_time = max(update_time)
             path = path[ update_time.index( max_update_time ) ][0]
             res = {'path':path, 'cache_time':max_update_time,
-                        'file_time':os.path.getmtime(path)}
+                        'file_time':entries[path].mtime if path in entries \
+                                else os.path.getmtime(path)}
         else:
             res = None
         return(res)
 
 
-    def update_cache_hash_metadata(self):
-    # Update metadata from IMDB for
+    def update_cache_hash_metadata(self, files):
+    # Update metadata from IMDB for hashs of files
     # If movie hash found in opensubtitles:
     # we already know the imdb id -> simple call
     # Else:
@@ -733,58 +2531,145 @@ class ListMovies():
     # If movie hash not found in opensubtitle and file modified after
     # our last imdb call -> we call imdb again
 
+    # Movies which IMDb requests failed are tried again next time
+
         cache = self.cache_hash
-        hashs = []
-        for h,v in cache.iteritems():
+        hashs, paths = [], {}
+        for h in self.hashs_from_paths(files):
 
-            p_info = self.path_from_hash(h)
-            if p_info:
-                path, c_time = p_info['path'], p_info['cache_time']
-                updt_after   = not v['o_title'] and v['m_last_update']<c_time
-                path_exists  = os.path.exists(path)
+            path = self._metadata_path(h)
+            if path:
+                hashs.append(h)
+                paths[h] = path
 
-                if path_exists and (not v['m_last_update'] or updt_after):
-                    hashs.append(h)
+        if not hashs:
+            return
 
         idx, last_len, total = 1, 0, len(hashs)
+        failed = []
+
+        # IMDb requests are done by a pool of threads, results being
+        # written in cache by the main thread
+        # titles of files unknown by opensubtitles are guessed in one go
+        unknown = [ h for h in hashs if not cache[h]['o_imdb_id'] ]
+        guesses = dict( zip( unknown, self.guessed_titles_years(
+            [ paths[h] for h in unknown ] ) ) )
+        jobs = [ (h, cache[h]['o_imdb_id'], paths[h], guesses.get(h))
+                for h in hashs ]
+        pool = ThreadPool( min(self.imdb_jobs, total) )
+        try:
+            for result in pool.imap_unordered( self.__get_metadata, jobs ):
+                out_str = u"Getting metadata: [%(index)i/%(nb_movies)i] "
+                out_str = out_str % {'index':idx,'nb_movies':total}
+                if len(out_str) < last_len:
+                    sys.stdout.write(' '*last_len+'\r')
+                self.flush_out_str(out_str)
 
-        for h in hashs:
-            self.log.info("get metadata for hash: %s" % str(h) )
-            out_str = u"Getting metadata: [%(index)i/%(nb_movies)i] "
-            out_str = out_str % {'index':idx,'nb_movies':total}
-            if len(out_str) < last_len:
-                sys.stdout.write(' '*last_len+'\r')
-            self.flush_out_str(out_str)
-
-            self.__get_metadata(h)
-            cache[h]['imdb_check'] = time.time()
-
-            if idx % 10 == 0:
-                self.save_cache()
-            idx += 1
-
-        if len(hashs)>0:
-            self.save_cache()
-            self.flush_out_str(' '*last_len+'\r')
+                if not self._set_metadata( result ):
+                    failed.append( result[0] )
 
+                if idx % 10 == 0:
+                    self.save_cache()
+                idx += 1
+        finally:
+            pool.terminate()
 
-    def __get_metadata(self, cur_hash):
+        self.save_cache()
+        self.flush_out_str(' '*last_len+'\r')
+
+        if failed:
+            # movies without m_last_update are tried again next time
+            self.log.error("IMDb metadata failed for %d movies, will be \
+retried next time: %s" % ( len(failed),
+                ", ".join( str(cache[h]['m_error']) for h in failed ) ))
+
+    def _needs_metadata(self, h, c_time):
+    # True for movies never looked for on IMDb, or not found on
+    # opensubtitles and which file was modified after the last look up
+    # @param c_time: cache time of the file
+        v = self.cache_hash[h]
+        updt_after = not v['o_title'] and v['m_last_update']<c_time
+        return not v['m_last_update'] or updt_after
+
+    def _metadata_path(self, h):
+    # file of h to look up on IMDb (the last cached one), None if h
+    # doesn't need metadata, its cache time being the one of the last
+    # cached file
+        p_info = self.path_from_hash(h)
+        if p_info and self._needs_metadata( h, p_info['cache_time'] ):
+            return p_info['path']
+        return None
+
+    def _set_metadata(self, result):
+    # writes the result of __get_metadata, returns False if IMDb failed
+        cache = self.cache_hash
+        h, info, fill, found, error = result
+        if error:
+            cache[h]['m_error'] = error
+        else:
+            cache[h].update( info )
+            if fill:
+                self.__fill_metadata( h, found )
+            cache[h]['m_error'] = None
+        cache[h]['imdb_check'] = time.time()
+        return not error
+
+    def _imdb(self):
+    # IMDb access object of current thread
+        i = getattr( self.imdb_local, 'i', None )
+        if i is None:
+            i = self.imdb_local.i = imdb.IMDb()
+        return i
+
+    def _imdb_call(self, method, *args):
+    # call an IMDb access method, from any thread, with rate limit, and
+    # retries with exponential backoff on IMDbError
+    # search_movie and get_movie answers are read from imdb_cache if there
+        key = imdb_cache_key( method, *args )
+        if key:
+            result = self.imdb_cache.get( key, self.imdb_cache )
+            if result is not self.imdb_cache:
+                self.log.debug("IMDb %s%s read from cache" % \
+                        (method, str(args)))
+                return result
+
+        for attempt in range(IMDB_RETRIES+1):
+            self.imdb_limiter.wait()
+            try:
+                result = getattr( self._imdb(), method )( *args )
+                if key:
+                    self.imdb_cache[key] = result
+                return result
+            except imdb.IMDbError, e:
+                if attempt == IMDB_RETRIES:
+                    raise
+                delay = IMDB_BACKOFF * 2**attempt
+                self.log.warning("IMDb %s%s failed (%s), retry in %is" % \
+                        (method, str(args), str(e), delay))
+                time.sleep( delay )
+
+    def __get_metadata(self, job):
     # "Get metadata for files not already in cache
-    # @param files: list of filenames (path or basenames)
-
-        cache_hash = self.cache_hash
-        imdb_id    = None
+    # runs in a worker thread: doesn't touch caches, but returns
+    # (hash, info, fill, found, error), to be written by caller:
+    # info: dict of guessed values to update
+    # fill: True if metadata have to be filled with found imdb movie
+    # error: error message if IMDb failed
+    # @param job: (hash, imdb id from opensubtitles, path, guessed title
+    # and year or None)
+
+        cur_hash, imdb_id, path, guess = job
+        info, fill, found = {}, False, None
+        self.log.info("get metadata for hash: %s" % str(cur_hash) )
 
         try:
 
             # if we have an imdb_id from opensubtitles for this hash
-            imdb_id = cache_hash[cur_hash]['o_imdb_id']
-
             if imdb_id:
                 self.log.info("IMDb id stored from Opensubtites %s" % imdb_id)
-                result = self.i.get_movie(imdb_id)
+                result = self._imdb_call( 'get_movie', imdb_id )
                 if result:
-                    self.__fill_metadata( cur_hash, result )
+                    fill, found = True, result
                 else:
                     self.log.warning("failed to get movie info from IMDB")
 
@@ -792,123 +2677,129 @@ class ListMovies():
                 # we need to guess a title, from a file pointing to this hash
                 self.log.info("no IMDb id stored from OpenSubtitles")
 
-                path  = self.path_from_hash( cur_hash )['path']
-                guess = self.guessed_title_year( path )
+                guess = guess or self.guessed_title_year( path )
                 self.log.debug("info guessed from filaneme %s" % str(guess) )
 
-                cache_hash[cur_hash].update( guess )
-
-                results = self.i.search_movie( guess['g_title'] )
-
-                if results:
-                    self.log.info("finding best match in answers")
-                    best_result, unsure = self.best_match( guess['g_title'],
-                            guess['g_year'], results)
-
+                info.update( guess )
+
+                best_result = None
+
+                # candidates from the offline title index first, IMDb
+                # search if none of them is a sure match
+                if self.title_index:
+                    results = self.title_index.search( guess['g_title'],
+                            guess['g_year'] )
+                    if results:
+                        self.log.info("finding best match in title index")
+                        best_result, unsure = self.best_match(
+                                guess['g_title'], guess['g_year'], results)
+                        if unsure:
+                            best_result = None
+
+                if not best_result:
+                    results = self._imdb_call( 'search_movie',
+                            guess['g_title'] )
+                    if results:
+                        self.log.info("finding best match in answers")
+                        best_result, unsure = self.best_match(
+                                guess['g_title'], guess['g_year'], results)
+
+                if best_result:
                     self.log.debug("best result for %s: %s" % \
                             (guess['g_title'], best_result.get('title')))
 
-                    cache_hash[cur_hash]['g_unsure'] = unsure
-                    self.i.update(best_result)
-                    self.__fill_metadata( cur_hash, best_result)
+                    info['g_unsure'] = unsure
+                    # same info as update(best_result), but cached
+                    fill, found = True, self._imdb_call( 'get_movie',
+                            best_result.movieID ) or best_result
                 else:
                     self.log.info("no result from IMDb, empty metadata")
-                    self.__fill_metadata( cur_hash, None )
-                    cache_hash[cur_hash]['g_unsure'] = True
+                    fill, found = True, None
+                    info['g_unsure'] = True
 
         except imdb.IMDbError, e:
-            print( "Connection error, current movie: [%s]" % \
-                    imdb_id if imdb_id else guess['g_title'] )
-            print e
-            self.save_cache()
-            sys.exit(2)
+            self.log.warning( "Connection error, current movie: [%s] %s" % \
+                    (imdb_id or os.path.basename(path), str(e)) )
+            return cur_hash, info, False, None, str(e) or repr(e)
+
+        return cur_hash, info, fill, found, None
 
 
     # ********** UNKNOW HASH MATCHER *****************************************
-    def best_match(self, guess_title, guess_year, results=None):
+    def best_match(self, guess_title, guess_year, results=None,
+            _candidates=None, _ratios=None):
         # Check match between the found movie and original filename
+        # titles of results are normalized once (_candidates), and ratios
+        # computed once by title (_ratios), the retry without year
+        # reusing both
+        # a ratio is only computed if its upper bounds (real_quick_ratio,
+        # quick_ratio) can beat the best one
 
         if not results:
-            results = self.i.search_movie( guess_title )
+            results = self._imdb_call( 'search_movie', guess_title )
 
         _guessed_title = alphanum( guess_title ).lower()
         _guessed_year  = guess_year
 
-        _results = [ r for r in results if isinstance(r,imdb.Movie.Movie) ]
+        if _candidates is None:
+            _norm = {}
+            def norm( title ):
+                if not _norm.has_key(title):
+                    _norm[title] = alphanum( title ).lower()
+                return _norm[title]
+            _candidates = [ (r, [ norm(title.split('::')[0]) \
+                                    for title in (r.get('akas') or []) ] + \
+                                [ norm(r.get('title')) ]) \
+                    for r in results if isinstance(r,imdb.Movie.Movie) ]
+        if _ratios is None:
+            _ratios = {}
+
+        _results = _candidates
         if _guessed_year:
-            _results = [ r for r in _results if r.has_key('year') \
+            _results = [ (r, t) for r, t in _results if r.has_key('year') \
                                         and r['year'] == _guessed_year ]
 
         _best_ratio  = 0
         _best_result = None
 
-        for r in _results:
-
-            _list_titles  = [ alphanum(title.split('::')[0]).lower() \
-                                    for title in (r.get('akas') or [])]
-            _list_titles += [ alphanum(r.get('title')).lower() ]
+        matcher = SequenceMatcher(None, '', _guessed_title)
+        for r, _list_titles in _results:
 
             for other_title in _list_titles:
-                cur_ratio = SequenceMatcher(None,
-                            other_title,_guessed_title).ratio()
+                cur_ratio = _ratios.get( other_title )
+                if cur_ratio is None:
+                    matcher.set_seq1( other_title )
+                    if matcher.real_quick_ratio() <= _best_ratio or \
+                            matcher.quick_ratio() <= _best_ratio:
+                        continue
+                    cur_ratio = _ratios[other_title] = matcher.ratio()
 
                 if cur_ratio > _best_ratio:
                     _best_ratio, _best_result = cur_ratio, r
                     self.log.info("ratio ==> %s (for [%s]) %f" % \
                                     ( other_title, _guessed_title, cur_ratio))
 
+            # nothing beats an exact match
+            if _best_ratio == 1.:
+                break
+
         unsure = _best_ratio < 0.7
 
         if _best_ratio < 0.7 and _guessed_year:
             self.log.info( "ratio <0.7 & year, we retry on base results")
-            _best_result, unsure = self.best_match(guess_title,None,results)
+            _best_result, unsure = self.best_match(guess_title, None,
+                    results, _candidates, _ratios)
 
         return _best_result, unsure
 
     def guessed_title_year( self, files ):
     # Try to guess title from movie filename
     # @param files: filename to parse
+        return guess_title_year( files, self.forbidden_words )
 
-        # we take everything before information in bracket
-        # or square bracket, as these info are usually not part of the title
-        title_reg = re.compile('^[^[(]+')
-        # the year is most of time placed between
-        # the title and other information, we are intersted by what is before
-        before_year_reg = re.compile(r'(.*)[12][1089][0-9]{2}.*')
-        # in some case, we have the title with lowercases,
-        # and other info (e.g. language) fully uppercase, this regex test this
-        upper_reg = re.compile(r'(^.+?)[A-Z]{2}.*')
-
-        init_title = os.path.splitext(os.path.basename(files))[0]
-
-        tmp_title = alphanum(
-                (re.findall(title_reg,init_title) or [init_title])[0] )
-        # 2nd regex
-        tmp_title = re.sub(before_year_reg, r'\1', tmp_title) or tmp_title
-        # 3rd regex
-        title     = re.sub(upper_reg,r'\1', tmp_title) or tmp_title
-
-        # In some cases, the previous regex give a wrong title,
-        # we try to detect this by cancelling too short title
-        if len(title) < 3:
-            title = tmp_title
-
-        title = title.strip().lower()
-
-        #we now remove forbidden words
-        title_words = title.split(' ')
-        for forbidden in self.forbidden_words:
-                if forbidden in title_words:
-                    title_words.remove(forbidden)
-        title = ' '.join(title_words)
-        guessed_year = re.findall('([12][1089][0-9]{2})', init_title) or None
-        guessed_year = int(guessed_year[0]) if guessed_year else None
-        if guessed_year < 1800 or 2100 < guessed_year:
-            guessed_year = None
-
-        return {'g_title':title.strip(), 'g_year':guessed_year}
-
-
+    def guessed_titles_years( self, files ):
+    # guessed_title_year of a list of filenames, in one go
+        return guess_titles_years( files, self.forbidden_words )
 
     def __fill_metadata(self, cur_hash, found):
     # Fill metadata for one movie
@@ -916,6 +2807,8 @@ class ListMovies():
     # @param found: the imdb movie object selected
 
         current = self.cache_hash[cur_hash]
+        self.cache_hash.reindex( cur_hash )
+        self.cache_lines.invalidate( cur_hash )
 
         current['m_last_update'] = time.time()
 
@@ -988,7 +2881,7 @@ class ListMovies():
             input_id = boolean_input("Will you provide an IMDb id?")
             if input_id:
                 imdb_id =raw_input('please enter the IMDb id for this movie:')
-                result = self.i.get_movie(imdb_id)
+                result = self._imdb_call( 'get_movie', imdb_id )
             else:
                 title =raw_input('please enter movie title:')
                 year  =raw_input('please enter year, leave blank if unknown:')
@@ -1048,10 +2941,9 @@ class ListMovies():
 
             if len(to_upload)>0:
                 try:
-                    self.login()
-                    call = self.server.InsertMovieHash( self.token, to_upload)
+                    call = self.opensubtitles.call( 'InsertMovieHash',
+                            to_upload )
                     print( call )
-                    logout = self.logout()
 
                     for v in to_upload:
                         h = v['moviehash']
@@ -1062,9 +2954,6 @@ class ListMovies():
                 except Exception, e:
                     print("!!! Error when uploading hash to opensubtitles")
                     print( e )
-                    if self.token:
-                        logout = self.logout()
-                        print( 'LOGOUT ***', logout )
 
     # ********** DOWNLOAD SUBTITLES FROM OPENSUBTITLES ***********************
 
@@ -1077,30 +2966,38 @@ class ListMovies():
             self.log.info("all subtitles already downloaded!")
             return
 
-        self.login()
-        sub_refs = self.server.SearchSubtitles( self.token, query )
+        # queries are sent by OPENSUBTITLE_SEARCHES, as answers are
+        # truncated to 500 subtitles
+        found = []
+        for k in range(0, len(query), OPENSUBTITLE_SEARCHES):
+            try:
+                sub_refs = self.opensubtitles.call( 'SearchSubtitles',
+                        query[k:k+OPENSUBTITLE_SEARCHES] )
+            except LoginError, e:
+                self.log.error("Subtitles download failed: %s" % str(e) )
+                return
+
+            if not self.status_ok(sub_refs):
+                self.log.error("Subtitles download failed: %s" % \
+                        str(sub_refs) )
+                return
+#               raise OpensubtitlesError
 
-        if self.status_ok(sub_refs):
             if sub_refs['data'] != False:
+                found.extend( sub_refs['data'] )
 
-                sub_ids = self.download_subtitles_filter(ref,sub_refs['data'])
-
-                self.log.debug( "list of subtitlesid to donwload: %s" %\
-                        ", ".join( sub_ids ) )
+        if found:
+            sub_ids = self.download_subtitles_filter(ref,found)
 
-                subs     = self.download_subtitleids( sub_ids )
-                if subs:
-                    self.download_subtitles_write(ref,subs,language)
+            self.log.debug( "list of subtitlesid to donwload: %s" %\
+                    ", ".join( sub_ids ) )
 
-            else:
-                self.log.info( "no subtitles found on OpenSubtitles %s" %\
-                        str(sub_refs) )
+            subs     = self.download_subtitleids( sub_ids )
+            if subs:
+                self.download_subtitles_write(ref,subs,language)
 
         else:
-            self.log.error("Subtitles download failed: %s" % str(sub_refs) )
-#            raise OpensubtitlesError
-
-        self.logout()
+            self.log.info( "no subtitles found on OpenSubtitles" )
 
     def download_subtitles_query( self, files, lang ):
     # build a useful info dictionary and the list of queries
@@ -1113,8 +3010,8 @@ class ListMovies():
             # check if we already downloaded subtitles for this movie
             pattern = lang.upper() + "_LM[\d]{1,}\.srt$"
             filedir = os.path.dirname(f)
-            old_subs = [ old for old in filelist(filedir,False) \
-                    if re.search(pattern, old) ]
+            old_subs = [ old.path for old in filelist(filedir,False) \
+                    if re.search(pattern, old.path) ]
 
             h           = self.cache_path[f]['hash']
             osbtls      = self.cache_hash[h]['o_imdb_id'] != None
@@ -1171,21 +3068,24 @@ class ListMovies():
     def download_subtitleids(self,sub_ids):
     # download, decode, and decompress a list of subtitles
     # @param sub_ids; list of subtitles id
+    # (at most OPENSUBTITLE_DOWNLOADS per request)
         subs = None
 
-        try:
-            result = self.server.DownloadSubtitles(self.token,sub_ids)
-        except Exception, e:
-            self.log.error("OpenSubtitle download sub error" % str(e) )
-            return( None )
+        for k in range(0, len(sub_ids), OPENSUBTITLE_DOWNLOADS):
+            try:
+                result = self.opensubtitles.call( 'DownloadSubtitles',
+                        sub_ids[k:k+OPENSUBTITLE_DOWNLOADS] )
+            except Exception, e:
+                self.log.error("OpenSubtitle download sub error %s" % str(e))
+                return( subs )
 
-        if self.status_ok(result):
-            if result['data'] != 'False':
-                subs = {}
-                for sub in result['data']:
-                    sub_d = base64.standard_b64decode(sub['data'])
-                    sub_d = zlib.decompress( sub_d, 47 )
-                    subs[sub['idsubtitlefile']] = sub_d
+            if self.status_ok(result):
+                if result['data'] != 'False':
+                    subs = subs or {}
+                    for sub in result['data']:
+                        sub_d = base64.standard_b64decode(sub['data'])
+                        sub_d = zlib.decompress( sub_d, 47 )
+                        subs[sub['idsubtitlefile']] = sub_d
 
         return(subs)
 
@@ -1199,6 +3099,8 @@ class ListMovies():
             keep = v['keep']
             if keep:
                 for i in range(len(keep)):
+                    if not subs.has_key(keep[i]):
+                        continue
                     sub_file = os.path.splitext(k)[0] + '_' + lang.upper() + \
                             '_LM' + str(i+1) + '.srt'
                     f = codecs.open(sub_file,'wb')
@@ -1206,14 +3108,23 @@ class ListMovies():
                     f.close()
 
     # ********** GATHERING & FILTERING FILES *********************************
+    def files_in_size_range(self, low=None, high=None):
+    # cached files which size is between low and high Mb (None for no
+    # bound), read from cache only: files are not accessed
+        to_bytes = lambda mb: None if mb is None else int(mb*1024*1024)
+        hashs = self.cache_hash.hashs_by_size( to_bytes(low), to_bytes(high) )
+        self.log.info("%d movies in size range" % len(hashs))
+        return self.cache_path.paths_from_hashs( hashs )
+
     def get_files(self,args):
     # Return files from args, if isdir -> recursive search
+    # FileEntry records of returned files are kept in self.file_entries
         result = []
         self.log.info("interpreting file/dir argument")
 
         if args[0]=='cache':
             self.log.info("loading all cache entries")
-            result.extend( self.cache_path.keys() )
+            result.extend( file_entry(f) for f in self.cache_path.keys() )
         else:
             for arg in args:
                 if not arg:
@@ -1232,98 +3143,262 @@ class ListMovies():
                     self.log.debug("dir to parse: %s" % real_path )
                     self.log.debug("dir var type: %s" % type(real_path) )
 
-                    result.extend( filelist(
-                        real_path, True, *self.file_ext ) )
+                    result.extend( self.scan_dir( real_path ) )
                 elif os.path.isfile(real_path):
-                    result.append(arg)
+                    result.append( file_entry(os.path.abspath(real_path)) )
 
-        result = [ r for r in result if \
-                os.path.exists(r) and os.path.getsize(r)>0L ]
+        result = [ r for r in result if r and r.size>0L ]
+        self.file_entries.update( (r.path, r) for r in result )
+        self.save_cache_dirs()
 
-        return result
+        return [ r.path for r in result ]
 
-    def user_filter(self, files):
-    # Filter movies according to user given arguments
-        self.log.info("number of files before filtering: %d" % len(files))
-        filt = self.filter_phrase
+    def stream_files(self, files):
+    # Generator of lists of files ready to be shown, for --stream
+    # Cached files come first, in one list. Others flow through
+    # hashing, OpenSubtitles and IMDb stages at the same time, and are
+    # yielded as soon as their movie is resolved (or failed).
+    # Workers put their results in a queue, caches are written by this
+    # thread only.
+        cache_path = self.cache_path
+        cache_hash = self.cache_hash
+        results = Queue.Queue()
+        waiting, batch, ready = {}, [], []
+        state = {'pending':0, 'batch_time':None, 'yielded':0}
+
+        def put( kind, fn, arg ):
+            try:
+                results.put( (kind, arg, fn(arg), None) )
+            except Exception, e:
+                results.put( (kind, arg, None, e) )
+
+        def submit( pool, kind, fn, arg ):
+            state['pending'] += 1
+            pool.apply_async( put, (kind, fn, arg) )
+
+        def flush_batch():
+            if batch:
+                submit( os_pool, 'checked', self._check_hash_batch,
+                        list(batch) )
+                del batch[:]
+                state['batch_time'] = None
+
+        def lookup( h, path ):
+            guess = None if cache_hash[h]['o_imdb_id'] else \
+                    self.guessed_title_year( path )
+            submit( imdb_pool, 'metadata', self.__get_metadata,
+                    (h, cache_hash[h]['o_imdb_id'], path, guess) )
+
+        def route( h, path, done ):
+        # next stage of a hashed file
+            if h in waiting:
+                waiting[h].append( path )
+            elif not h or not cache_hash.has_key(h):
+                done.append( path )
+            elif self._to_check_opensubtitles(h):
+                waiting[h] = [path]
+                batch.append( h )
+                if state['batch_time'] is None:
+                    state['batch_time'] = time.time()
+                if len(batch) >= self.opensubtitles_batch:
+                    flush_batch()
+            else:
+                lookup_path = self._metadata_path( h )
+                if lookup_path:
+                    waiting[h] = [path]
+                    lookup( h, lookup_path )
+                else:
+                    done.append( path )
+
+        def hashing( entries ):
+            try:
+                for entry, h in self.hash_files( entries ):
+                    results.put( ('hashed', entry, h, None) )
+            finally:
+                results.put( ('hashed_all', None, None, None) )
+
+        cache_path.prefetch( files )
+        to_hash, cached = [], []
+        for path in files:
+            entry = self.file_entries.get(path) or file_entry(path)
+            if not entry:
+                self.log.warning("can't stat file: %s" % path)
+            elif self._is_cached( entry ):
+                cached.append( path )
+            else:
+                to_hash.append( entry )
+        self.hashs_from_paths( cached )
+
+        os_pool = ThreadPool( self.opensubtitles_jobs )
+        imdb_pool = ThreadPool( self.imdb_jobs )
         try:
-            while filt:
-
-                if filt[0]!='@':
-                    raise FilterParsingError
-                end = filt.find(':')
-
-                if end == -1:
-                    raise FilterParsingError
-                filter_type = filt[1:end]
-
-                if not filter_type in ['genre','director','actor','size',
-                       'country','unsure']:
-                    raise FilterParsingError
-
-                if filter_type=="actor":
-                    filter_type='cast'
-                elif filter_type=="country":
-                    filter_type="countries"
-                filt = filt[end+1:]
-                end = filt.find('@')
-
-                if end == -1:
-                    end = None
-                keys = set([key.lower() for key in filt[:end].split(',')])
-                filt = filt[end:] if end else ''
-
-                if filter_type =='size':
-                    self.log.info("filtering by size")
-
-                    if (len(keys)>1):
-                        raise FilterParsingError
-                    try:
-                        keys = list(keys)[0]
-
-                        if keys[0] in ['-','+']:
-                            sign = 1 if keys[0] == '+' else -1
-                            keys = keys[1:]
+            for path in cached:
+                route( cache_path[path]['hash'], path, ready )
+            if ready:
+                yield ready
+
+            if to_hash:
+                state['pending'] += 1
+                thread = threading.Thread( target=hashing, args=(to_hash,) )
+                thread.daemon = True
+                thread.start()
+            else:
+                flush_batch()
+
+            while state['pending']:
+                # a partial batch is sent when no hash came for a while
+                # (get() has a timeout, not to block Ctrl-C)
+                wait = OPENSUBTITLE_STREAM_WAIT
+                if state['batch_time'] is not None:
+                    wait = state['batch_time'] + wait - time.time()
+                try:
+                    kind, arg, result, error = results.get( True,
+                            max(0, wait) )
+                except Queue.Empty:
+                    flush_batch()
+                    continue
+
+                done = []
+                if kind == 'hashed':
+                    h = self._cache_hashed( arg, result )
+                    route( h, arg.path, done )
+
+                elif kind == 'hashed_all':
+                    state['pending'] -= 1
+                    flush_batch()
+
+                elif kind == 'checked':
+                    state['pending'] -= 1
+                    found = result[0] if result else {}
+                    if error:
+                        self.log.error("OpenSubtitles request failed: %s" \
+                                % str(error))
+                    elif result[3]:
+                        self.log.error("OpenSubtitles request failed for \
+%d movies (%s): %s" % ( len(result[3][0]), ", ".join(result[3][0]),
+                            result[3][1] ))
+                    # movies not checked are tried again next time, on
+                    # OpenSubtitles then IMDb
+                    for h in arg:
+                        path = None
+                        if found.has_key(h):
+                            self._set_opensubtitles_info( h, found[h] )
+                            path = self._metadata_path( h )
+                        if path:
+                            lookup( h, path )
                         else:
-                            sign = 1
+                            done.extend( waiting.pop(h) )
+
+                elif kind == 'metadata':
+                    state['pending'] -= 1
+                    h = arg[0]
+                    if error:
+                        result = (h, None, False, None, str(error))
+                    if not self._set_metadata( result ):
+                        self.log.error("IMDb metadata failed for %s: %s" % \
+                                (waiting[h][0], cache_hash[h]['m_error']))
+                    done.extend( waiting.pop(h) )
+
+                if done:
+                    state['yielded'] += 1
+                    if state['yielded'] % 10 == 0:
+                        self.save_cache()
+                    yield done
+        finally:
+            os_pool.terminate()
+            imdb_pool.terminate()
+            self.save_cache()
 
-                        keys = float(keys)
-                        self.log.info("filtering key: %s%f" % \
-                                ( "> " if sign==1 else "< ", keys))
-                    except:
-                        raise FilterParsingError
-                    files = [ f for f in files if \
-                            sign*keys < sign*os.path.getsize(f)/(1020*1024) ]
+    def scan_dir(self, root):
+    # Return FileEntry records of video files in root, recursively.
+    # Directories with same mtime as in the manifest are not listed
+    # again: their files and subdirs are read from the manifest, files
+    # being still stat'ed, as a file modified in place doesn't change its
+    # directory mtime
+        root = os.path.abspath(root)
+        result, seen = [], set()
+        listed, todo = 0, [root]
+
+        while todo:
+            cur_dir = todo.pop()
+            try:
+                mtime = os.stat(cur_dir).st_mtime
+            except OSError:
+                continue
+            seen.add(cur_dir)
+
+            known = self.cache_dirs.get(cur_dir)
+            if known and known[0] == mtime and not self.rescan:
+                files = [ e for e in map( file_entry, known[1] ) if e ]
+                subdirs = known[2]
+            else:
+                listed += 1
+                files, subdirs = dir_content( cur_dir, *self.file_ext )
+                self.cache_dirs[cur_dir] = ( mtime,
+                        [ f.path for f in files ], subdirs )
+                self.cache_dirs_changed = True
+
+            result.extend( files )
+            todo.extend( reversed(subdirs) )
+
+        # forget directories which disappeared from this tree
+        prefix = os.path.join( root, u'' )
+        for d in [ d for d in self.cache_dirs if d not in seen and \
+                (d==root or d.startswith(prefix)) ]:
+            del self.cache_dirs[d]
+            self.cache_dirs_changed = True
+
+        self.log.info("%d directories scanned, %d listed" % \
+                (len(seen),listed))
+        return result
 
+    def user_filter(self, files):
+    # Filter movies according to user given arguments
+    # clauses are compiled from filter_dict (see compile_filter), and
+    # genre, actor, director and country ones read from the terms index
+        self.log.info("number of files before filtering: %d" % len(files))
 
-                elif filter_type == 'unsure':
-                    self.log.info("filtering unsure movies")
-                    files = [ f for f in files if \
-                        self.cache_hash[\
-                            self.cache_path[f]['hash']]['g_unsure'] ]
+        hashs = dict( (f, self.cache_path[f]['hash']) for f in files
+                if self.cache_path.has_key(f) )
+        files = [ f for f in files if hashs.has_key(f) ]
+        self.cache_hash.prefetch( hashs.values() )
+
+        for clause in compile_filter( self.filter_dict ):
+            if not files:
+                break
+            filter_type = clause[0]
+
+            if filter_type =='size':
+                self.log.info("filtering by size")
+                found = set()
+                for sign, keys in clause[1]:
+                    self.log.info("filtering key: %s%f" % \
+                            ( "> " if sign==1 else "< ", keys))
+                    bound = int( keys*1024*1024 )
+                    found.update( self.cache_hash.hashs_by_size( strict=True,
+                            **{'low' if sign==1 else 'high':bound} ) )
+                files = [ f for f in files if hashs[f] in found ]
+
+            elif filter_type == 'unsure':
+                self.log.info("filtering unsure movies")
+                files = [ f for f in files if \
+                        self.cache_hash[ hashs[f] ]['g_unsure'] ]
 
-                else:
-                    self.log.info("filtering type: %s" %filter_type )
-                    self.log.info("filtering keys: %s" % ", ".join(keys))
-
-                    filter_type = 'm_' + filter_type
-                    files = filter( lambda m:\
-                        set([key.lower() for
-                        key in self.hash_from_path(m)[filter_type]]).\
-                                intersection(keys), files)
-        except FilterParsingError:
-            self.log.error("Invalid filter ! Please read README for syntax")
-            files = []
+            else:
+                keys = clause[1]
+                self.log.info("filtering type: %s" %filter_type )
+                self.log.info("filtering keys: %s" % ", ".join(keys))
+                found = self.cache_hash.hashs_with_terms( filter_type, keys )
+                files = [ f for f in files if hashs[f] in found ]
 
-        finally:
-            self.log.info("number of files after filtering %d" % len(files))
-            return files
+        self.log.info("number of files after filtering %d" % len(files))
+        return files
 
     def filter_and_sort_files( self, files):
     # filter the list of files,
     # according to video extensions provided, and user filters
 
-        if self.filter_phrase:
+        if self.filter_dict:
             files = self.user_filter(files)
 
         if self.order_alpha:
@@ -1331,33 +3406,180 @@ class ListMovies():
         else:
             keyword = 'm_rating'
 
-        files.sort( key=lambda f: self.hash_from_path(f)[keyword],\
-                reverse=self.order_reverse)
+        keys = self.sort_keys( files, keyword )
+
+        # first files of the sorted list only: nsmallest and nlargest
+        # give the same files, in the same order, as sort()[:limit]
+        if self.limit is not None:
+            top = heapq.nlargest if self.order_reverse else heapq.nsmallest
+            return top( max(0, self.limit), files, key=keys.__getitem__ )
+
+        files.sort( key=keys.__getitem__, reverse=self.order_reverse)
 
         return(files)
 
+    def sort_keys(self, files, keyword):
+    # {path: value of keyword} for a list of files, rows being read in
+    # one go (None for files not in cache, as hash_from_path)
+        self.cache_path.prefetch( files )
+        hashs = dict( (f, self.cache_path[f]['hash']) for f in files
+                if self.cache_path.has_key(f) )
+        self.cache_hash.prefetch( hashs.values() )
+
+        keys = {}
+        for f in files:
+            record = self.cache_hash[ hashs[f] ] if hashs.has_key(f) \
+                    else None
+            if record is None:
+                self.log.error("this path doesnt belong to cash_path %s" % f)
+            keys[f] = record[keyword] if record is not None else None
+        return keys
+
     def hash_from_path(self,path):
         try:
             cur_hash    = self.cache_path[path]['hash']
             result      = self.cache_hash[cur_hash]
         except:
             self.log.error("this path doesnt belong to cash_path %s" % path )
-            result      = store()
+            result      = movie_record()
 
         return( result )
 
     # ********** DISPLAYERS **************************************************
     def show_list(self, files):
-        for f in files:
-            self.pretty_print(f)
-
+        out = output_buffer( sys.stdout )
+        self.write_list( files, out, header=True )
+        out.flush()
+
+    def show_stream(self, batches):
+    # Print lists of files from stream_files as they come, filtered,
+    # up to self.limit movies
+        out = output_buffer( sys.stdout )
+        shown, header = 0, True
+        try:
+            for files in batches:
+                if self.filter_dict:
+                    files = self.user_filter(files)
+                limit = None if self.limit is None else self.limit-shown
+                shown += self.write_list( files, out, header, limit )
+                header = False
+                out.flush()
+                if limit is not None and shown >= self.limit:
+                    return
+        finally:
+            out.flush()
+            batches.close()
+
+    def write_list(self, files, out, header=False, limit=None):
+    # Write movies of files to out, in --format or as text lines
+    # (cache rows are read in one go), returns the number of movies
+    # Movies with a pre-rendered line are written without reading their
+    # record, unless plot outlines are shown
+        cache_path = self.cache_path
+        cache_hash = self.cache_hash
+        cache_lines = self.cache_lines
+        cache_path.prefetch( files )
+        paths = [ cache_path[f] for f in files ]
+        hashs = [ p['hash'] for p in paths if p is not None ]
+
+        mode = self.display_mode()
+        rendered = not self.out_format and not self.disp_outline
+        if not self.out_format:
+            cache_lines.prefetch( hashs )
+        if rendered:
+            hashs = [ k for k in hashs if cache_lines.line(k, mode) is None \
+                    or cache_hash.changed(k) ]
+        cache_hash.prefetch( hashs )
+
+        if self.out_format == 'csv':
+            writer = csv.writer( out, lineterminator='\n' )
+            write_row = writer.writerow
+        elif self.out_format == 'tsv':
+            write_row = lambda row: out.write( '\t'.join( v.replace('\t',
+                ' ').replace('\n', ' ').replace('\r', ' ') for v in row ) \
+                        + '\n' )
+        if header and self.out_format in ('csv', 'tsv'):
+            write_row( OUTPUT_FIELDS )
+
+        shown = 0
+        for f, p in izip( files, paths ):
+            if limit is not None and shown >= limit:
+                break
+            if rendered and p is not None:
+                line = cache_lines.line( p['hash'], mode )
+                if line is not None and not cache_hash.changed( p['hash'] ):
+                    out.write( line.replace( FILENAME_MARK,
+                        os.path.basename(f).encode('utf-8') ) )
+                    shown += 1
+                    continue
+            h = cache_hash[ p['hash'] ] if p is not None else None
+            if h is None:
+                self.log.error("this path doesnt belong to cash_path %s" % f)
+                continue
+            if not h['m_id']:
+                continue
+            shown += 1
+
+            if self.out_format == 'jsonl':
+                out.write( json.dumps( OrderedDict( (k, f if k=='path' \
+                        else h[k]) for k in OUTPUT_FIELDS ) ) + '\n' )
+            elif self.out_format:
+                write_row( [ self._field_text(f if k=='path' else h[k]) \
+                        for k in OUTPUT_FIELDS ] )
+            else:
+                out.write( self.render(f, h) )
+        return shown
+
+    @staticmethod
+    def _field_text( value ):
+    # a cache value as utf-8 text for csv/tsv: lists joined by '|'
+        if value is None:
+            return ''
+        if isinstance( value, (list, tuple) ):
+            value = u'|'.join( value )
+        if isinstance( value, unicode ):
+            return value.encode('utf-8')
+        return str( value )
 
     def pretty_print(self, filename):
     # Print movie with metadata and colors according to arguments
+        out_str = self.render( filename )
+        if out_str:
+            sys.stdout.write( out_str )
 
-        h = self.hash_from_path(filename)
+    def display_mode(self):
+    # current mode of text listings, one of DISPLAY_MODES
+        if self.disp_very_long:
+            return 'very_long'
+        elif self.disp_long:
+            return 'long'
+        return 'short'
+
+    def render(self, filename, h=None):
+    # Text of a movie with metadata and colors according to arguments,
+    # utf-8 encoded ('' for files without movie)
+        if h is None:
+            h = self.hash_from_path(filename)
         if not h['m_id']:
-            return(0)
+            return('')
+
+        mode = self.display_mode()
+        # lines of records changed since last save are rendered again
+        out_str = self.cache_lines.line( h._key, mode )
+        if out_str is None or self.cache_hash.changed( h._key ):
+            out_str = self.render_line( h, mode )
+            self.cache_lines.set_line( h._key, mode, out_str )
+        out_str = out_str.replace( FILENAME_MARK,
+                os.path.basename(filename).encode('utf-8') )
+
+        if self.disp_outline and h['m_short_summary']:
+            out_str += unicode( \
+                    '*** ' + h['m_short_summary']+'\n').encode('utf-8')
+        return out_str
+
+    def render_line(self, h, mode):
+    # Text of a movie record in a DISPLAY_MODES, utf-8 encoded, with
+    # FILENAME_MARK in place of the filename
 
         values_dict = {'b':self.BLUE,
                        'e':self.END,
@@ -1369,13 +3591,13 @@ class ListMovies():
                        'rating':str(h['m_rating']),
                        'year':h['m_year'],
                        'genre':"%s" % ', '.join(h['m_genre']),
-                       'filename':os.path.basename(filename),
+                       'filename':FILENAME_MARK,
                        'director':', '.join(h['m_director']),
                        'size': str(int(h['bytesize'] / (1024*1024))) \
                                if h['bytesize'] else None
                       }
 
-        if self.disp_very_long:
+        if mode == 'very_long':
             out_str  =u"%(header)s%(title)s (%(b)srating%(e)s: %(rating)s)\n%"
             out_str +="(b)syear%(e)s: %(year)s %(b)sgenre%(e)s: %(genre)s\n%"
             out_str +="(b)sfile%(e)s: %(filename)s %(b)ssize%(e)s: %(size)sMo"
@@ -1394,59 +3616,98 @@ class ListMovies():
                     out_str+=len_cast_header*u' '+actor+'\n'
             out_str += "\n" + self.BLUE + "summary"+self.END+": %s\n---\n" % \
                     h['m_summary']
-        elif self.disp_long:
+        elif mode == 'long':
             out_str = u"%(header)s%(title)s (%(year)s,%(rating)s,%(size)sMo) "
             out_str += "[%(b)s%(genre)s%(e)s] from %(director)s: "
             out_str += "%(filename)s\n"
             out_str = out_str % values_dict
         else:
             out_str = u"%(header)s%(title)s (%(filename)s)\n" % values_dict
-        sys.stdout.write(out_str.encode('utf-8'))
-        if self.disp_outline and h['m_short_summary']:
-            sys.stdout.write(unicode( \
-                    '*** ' + h['m_short_summary']+'\n').encode('utf-8'))
+        return out_str.encode('utf-8')
 
     def html_build(self, files):
-    # Show the list of files, using metadata according to arguments
-
-        cell = u"<td width=200 height=250><a href=\"%(imdb)s\">\
-           %(title)s</a><br> \
-           <font color=%(color)s>%(genre)s<br>\
-           note: %(rating)s, votes: %(votes)s<br>\
-           size: %(size)iMo</font><br>\
-           <a href='%(trailer)s'><img src='%(cover)s' height=150></a><br>\
-           <small>%(file)s</small></td>\n"
-
-        with codecs.open(self.html_fn,'w','utf-8') as out_file:
-            out_file.write("<table>\n")
-            count = 0
-            for f in files:
-                if count % 5 == 0:
-                    if count > 0: out_file.write("</tr>")
-                    out_file.write("<tr height=200>")
-
-                h = self.hash_from_path(f)
-                if h['m_id']:
-                    values_dict = {
-                        'imdb' :'http://www.imdb.com/title/tt'+h['m_id'],
-                        'file' : os.path.basename(f)[0:20],
-                        'size' : round(h['bytesize']/(1024*1024),1)\
-                        if os.path.exists(f) else 0,
-                        'title': h['m_title'],
-                        'color': '#FF3333' if h['g_unsure'] else '#808080',
-                        'rating' : str(h['m_rating']) or 'None',
-                        'votes': str(round(h['m_votes']/1000,1))+'K' if \
-                                h['m_votes'] else 'None',
-                        'cover': h['m_cover'],
-                        'genre': ', '.join(h['m_genre'][0:2]),
-                     'trailer':'http://www.youtube.com/results?search_query='+
-                                alphanum( h['m_title'],'+')+'+trailer'
-                                }
-                    # print values_dict
-                    finalcell = cell % values_dict
-                    out_file.write( finalcell )
-                count += 1
-            out_file.write("</tr></table>")
+    # Build the HTML sumup of files (see HTML_PAGE): movies are split in
+    # data files by their path, so that a movie change only changes
+    # one file, and files which content didn't change since last build
+    # are not written again (their signatures are kept in a manifest)
+
+        movies = self.html_movies( files )
+
+        if not os.path.exists( self.html_dir ):
+            os.makedirs( self.html_dir )
+        manifest_fn = os.path.join( self.html_dir, 'manifest.json' )
+        try:
+            with open( manifest_fn ) as f:
+                manifest = json.load( f )
+        except (IOError, ValueError):
+            manifest = {}
+
+        # changing the number of data files moves most movies to another
+        # one: the number of last build is kept while data files hold
+        # from HTML_PAGE_SIZE/4 to 2*HTML_PAGE_SIZE movies on average
+        nb_pages = len( manifest ) or 1
+        if len(movies) > 2*HTML_PAGE_SIZE*nb_pages or \
+                (nb_pages > 1 and 4*len(movies) < HTML_PAGE_SIZE*nb_pages):
+            nb_pages = 1
+            while nb_pages * HTML_PAGE_SIZE < len(movies):
+                nb_pages *= 2
+        pages = [ [] for n in range(nb_pages) ]
+        for path, row in movies:
+            pages[ (zlib.crc32(path.encode('utf-8')) & 0xffffffff) % \
+                    nb_pages ].append( (path, row) )
+
+        signatures, written = {}, 0
+        for n, page in enumerate( pages ):
+            name = "page_%04d.js" % n
+            data = "lm_page(%d,%s);\n" % ( n, json.dumps( [ row for path,
+                row in sorted(page) ], separators=(',',':') ) )
+            signatures[name] = hashlib.md5( data ).hexdigest()[:16]
+            page_fn = os.path.join( self.html_dir, name )
+            if manifest.get(name) != signatures[name] or \
+                    not os.path.exists( page_fn ):
+                write_file( page_fn, data )
+                written += 1
+
+        for name in manifest:
+            if not name in signatures and \
+                    os.path.exists( os.path.join(self.html_dir, name) ):
+                os.remove( os.path.join(self.html_dir, name) )
+
+        index = {'fields':HTML_FIELDS, 'total':len(movies),
+                'pages':sorted( signatures.items() ),
+                'sort':'title' if self.order_alpha else 'rating',
+                'reverse':self.order_reverse}
+        write_file( os.path.join( self.html_dir, 'index.js' ),
+                "lm_index(%s);\n" % json.dumps( index ) )
+        write_file( manifest_fn, json.dumps( signatures ) )
+
+        html = ( HTML_PAGE % {'data':os.path.basename(self.html_dir),
+            'view_size':HTML_VIEW_SIZE} ).encode('utf-8')
+        try:
+            with open( self.html_fn, 'rb' ) as f:
+                changed = f.read() != html
+        except IOError:
+            changed = True
+        if changed:
+            write_file( self.html_fn, html )
+
+        self.log.info("html sumup: %d movies, %d/%d data files written" % \
+                ( len(movies), written, nb_pages ))
+
+    def html_movies(self, files):
+    # [(path, row of HTML_FIELDS values)] of movies of files
+        self.hashs_from_paths( files )
+        movies = []
+        for f in files:
+            h = self.hash_from_path(f)
+            if not h['m_id']:
+                continue
+            movies.append( (f, [ os.path.basename(f), h['m_id'],
+                h['m_title'], h['m_year'], h['m_rating'], h['m_votes'],
+                h['m_genre'] or [], h['m_director'] or [],
+                round( (h['bytesize'] or 0)/(1024.*1024), 1 ),
+                bool(h['g_unsure']), h['m_cover'] or None ]) )
+        return movies
 
     def html_show(self):
         webbrowser.open_new_tab( "file://%s" % self.html_fn )
@@ -1493,15 +3754,37 @@ if __name__ == "__main__":
         LM.reset_cache_files()
         sys.exit()
 
-    files = LM.get_files(args)
+    if options.build_title_index:
+        try:
+            LM.build_title_index( *options.build_title_index )
+        finally:
+            LM.close_cache()
+        sys.exit()
+
+    if options.refresh_ratings:
+        LM.refresh_ratings( options.refresh_ratings )
+        LM.close_cache()
+        sys.exit()
+
+    if options.size_range:
+        files = LM.files_in_size_range( *options.size_range )
+    else:
+        files = LM.get_files(args)
+
+    if options.stream:
+        LM.show_stream( LM.stream_files(files) )
+        LM.close_cache()
+        sys.exit()
 
     if options.delete_cache:
         LM.delete_cache(files)
         sys.exit()
 
-    LM.update_caches_with_paths( files )
-    LM.update_cache_hash_opensubtitles()
-    LM.update_cache_hash_metadata()
+    # a size range is answered from cache, without updating it
+    if not options.size_range:
+        LM.update_caches_with_paths( files )
+        LM.update_cache_hash_opensubtitles( files )
+        LM.update_cache_hash_metadata( files )
     files = LM.filter_and_sort_files(files)
 
     if options.confirm:
@@ -1524,3 +3807,5 @@ if __name__ == "__main__":
     else:
         LM.show_list( files )
 
+    LM.close_cache()
+